@@ -0,0 +1,127 @@
+""" This file holds the scheduler that keeps slow, interactive computations
+	off the Qt thread. It is shared by the threshold label in Threshold.py
+	and the ROI surface in ROI.py.
+"""
+
+from __main__ import qt
+
+from Helper import *
+
+import threading
+
+class LatestWinsScheduler( object ):
+
+	""" Runs compute(request) on a worker thread, one request at a time. While
+		a computation is running, newly submitted requests replace the one
+		waiting, so only the newest is ever computed next. Finished results are
+		handed to publish(result) on the Qt thread by a polling timer, since
+		MRML nodes must not be touched from the worker. A new computation is
+		not started until the previous result has been published, so compute
+		and publish may safely share buffers. With dropObsolete, a result is
+		thrown away instead of published if a newer request came in while it
+		was computed; compute can also stop early by polling isObsolete.
+	"""
+
+	def __init__( self, compute, publish, pollInterval=20, dropObsolete=False ):
+
+		self.__compute = compute
+		self.__publish = publish
+		self.__dropObsolete = dropObsolete
+
+		self.__lock = threading.Lock()
+		self.__thread = None
+		self.__pending = None
+		self.__result = None
+
+		self.__timer = qt.QTimer()
+		self.__timer.setInterval(pollInterval)
+		self.__timer.connect('timeout()', self.__poll)
+
+	def submit( self, request ):
+
+		with self.__lock:
+			self.__pending = [request]
+			self.__startIfIdle()
+		self.__timer.start()
+
+	def isObsolete( self ):
+
+		""" Whether a newer request is waiting for the running computation.
+		"""
+
+		with self.__lock:
+			return self.__pending != None
+
+	def isIdle( self ):
+
+		with self.__lock:
+			return self.__thread == None and self.__pending == None and self.__result == None
+
+	def finish( self ):
+
+		""" Blocks until every submitted request has been computed and published.
+			Used when leaving the step, so the label matches the final slider range.
+		"""
+
+		while not self.isIdle():
+			thread = self.__thread
+			if thread != None:
+				thread.join()
+			self.__poll()
+
+	def cancel( self ):
+
+		""" Forgets the waiting request and any unpublished result. A computation
+			already running is allowed to finish, but its result is dropped.
+		"""
+
+		with self.__lock:
+			self.__pending = None
+		thread = self.__thread
+		if thread != None:
+			thread.join()
+		with self.__lock:
+			self.__result = None
+		self.__timer.stop()
+
+	def __startIfIdle( self ):
+
+		# Must be called with the lock held.
+		if self.__thread != None or self.__pending == None or self.__result != None:
+			return
+
+		request = self.__pending[0]
+		self.__pending = None
+		self.__thread = threading.Thread(target=self.__run, args=(request,))
+		self.__thread.daemon = True
+		self.__thread.start()
+
+	def __run( self, request ):
+
+		try:
+			result = [self.__compute(request), None]
+		except Exception as e:
+			result = [None, e]
+
+		with self.__lock:
+			if not (self.__dropObsolete and self.__pending != None):
+				self.__result = result
+			self.__thread = None
+
+	def __poll( self ):
+
+		with self.__lock:
+			finished = self.__result
+
+		if finished != None:
+			if finished[1] != None:
+				Helper.Error('Background computation failed: ' + str(finished[1]))
+			else:
+				self.__publish(finished[0])
+
+		with self.__lock:
+			self.__result = None
+			self.__startIfIdle()
+
+		if self.isIdle():
+			self.__timer.stop()
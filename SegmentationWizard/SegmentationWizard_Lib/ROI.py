@@ -20,6 +20,7 @@ from Helper import *
 import PythonQt
 import os 
 from VolumeClipWithModel import *
+from LatestWinsScheduler import LatestWinsScheduler
 
 """ ROIStep inherits from SegmentationWizardStep, with itself inherits
     from a ctk workflow class. PythonQT is required for this step
@@ -46,6 +47,20 @@ class ROIStep( SegmentationWizardStep ) :
         self.__clippingModelNode = None
         self.__clippingMarkupNode = None
         self.__clippingMarkupNodeObserver = None
+        self.__visualizedVolume = None
+
+        # While markups are being dragged only the raw hull is shown. The smooth
+        # surface is computed once the markups have stopped changing for a moment.
+        self.__refineTimer = qt.QTimer()
+        self.__refineTimer.setSingleShot(True)
+        self.__refineTimer.setInterval(300)
+        self.__refineTimer.connect('timeout()', self.updateModelFromClippingMarkupNode)
+
+        # ROI surfaces are built off the Qt thread. A newer markup change makes
+        # any surface still being built obsolete, so it is dropped. So is one for
+        # another ROI, but a model only counts as subdivided once its surface is
+        # published, so onExit rebuilds any ROI whose surface was dropped.
+        self.__modelScheduler = LatestWinsScheduler(self.buildModelSurface, self.publishModelSurface, dropObsolete=True)
         
         # For future implementation of multiple models.
         self.__modelList = []
@@ -132,6 +147,45 @@ class ROIStep( SegmentationWizardStep ) :
         self.__clippingMarkupSelector.setToolTip("Use markup points to determine a convex ROI.")
         self.__convexGroupBoxLayout.addRow("Convex ROI Markups: ", self.__clippingMarkupSelector)
 
+        self.__roiReadout = qt.QLabel()
+        self.__roiReadout.setToolTip("Estimated from a sample of the voxels inside the convex hull of your markups.")
+        self.__convexGroupBoxLayout.addRow("ROI Size: ", self.__roiReadout)
+
+        self.__concaveCheckBox = qt.QCheckBox()
+        self.__concaveCheckBox.checked = False
+        self.__concaveCheckBox.setToolTip("Wrap your markup points tightly, following indentations, instead of with a convex bubble. This needs more markups, spread evenly over the ROI.")
+        self.__concaveCheckBox.connect('toggled(bool)', self.onConcaveToggled)
+        self.__convexGroupBoxLayout.addRow("Concave ROI: ", self.__concaveCheckBox)
+
+        self.__marginSpinBox = qt.QDoubleSpinBox()
+        self.__marginSpinBox.setRange(-50, 50)
+        self.__marginSpinBox.setSingleStep(1)
+        self.__marginSpinBox.setDecimals(1)
+        self.__marginSpinBox.setSuffix(' mm')
+        self.__marginSpinBox.setValue(0)
+        self.__marginSpinBox.setToolTip("Grow (positive) or shrink (negative) your ROI by this distance when it is clipped.")
+        self.__convexGroupBoxLayout.addRow("ROI Margin: ", self.__marginSpinBox)
+
+        self.__hullClipCheckBox = qt.QCheckBox()
+        self.__hullClipCheckBox.checked = False
+        self.__hullClipCheckBox.setToolTip("Clip directly to the convex hull of your markup points instead of the smoothed model. This is faster, but the ROI will have flat faces.")
+        self.__convexGroupBoxLayout.addRow("Fast Exact Hull Clipping: ", self.__hullClipCheckBox)
+
+        self.__componentsCheckBox = qt.QCheckBox()
+        self.__componentsCheckBox.checked = False
+        self.__componentsCheckBox.setToolTip("Also create a label map in which every ROI has its own label value, so that multifocal lesions can be told apart.")
+        self.__convexGroupBoxLayout.addRow("Label Each ROI Separately: ", self.__componentsCheckBox)
+
+        self.__cropCheckBox = qt.QCheckBox()
+        self.__cropCheckBox.checked = False
+        self.__cropCheckBox.setToolTip("Store only the bounding box of your ROIs in the cropped volume, instead of a copy of the whole volume. This saves memory with large volumes.")
+        self.__convexGroupBoxLayout.addRow("Crop Output to ROI: ", self.__cropCheckBox)
+
+        self.__clipAllCheckBox = qt.QCheckBox()
+        self.__clipAllCheckBox.checked = False
+        self.__clipAllCheckBox.setToolTip("Also clip your baseline and followup volumes to the ROI, for example to report intensities in each.")
+        self.__convexGroupBoxLayout.addRow("Also Clip Baseline and Followup: ", self.__clipAllCheckBox)
+
         self.__layout.addRow(self.__convexGroupBox)
 
         # In case we wanted to set specific parameters for Volume Clip...
@@ -210,14 +264,47 @@ class ROIStep( SegmentationWizardStep ) :
 
     def onClippingMarkupNodeModified(self, observer, eventid):
 
-        self.updateModelFromClippingMarkupNode()
+        self.updateModelFromClippingMarkupNode(subdivide=False)
+        self.__refineTimer.start()
 
-    def updateModelFromClippingMarkupNode(self):
+    def updateModelFromClippingMarkupNode(self, subdivide=True):
 
         if not self.__clippingMarkupNode or not self.__clippingMarkupSelector.currentNode():
             return
 
-        self.__logic.updateModelFromMarkup(self.__clippingMarkupNode, self.__clippingModelNode)
+        request = self.__logic.getModelRequest(self.__clippingMarkupNode, self.__clippingModelNode, subdivide, self.__concaveCheckBox.checked)
+        if request != None:
+            request['modelID'] = self.__clippingModelNode.GetID()
+            self.__modelScheduler.submit(request)
+
+        self.updateROIReadout()
+
+    def updateROIReadout(self):
+
+        # A quick estimate, so that users can judge the ROI before the full clip when leaving the step.
+        statistics = None
+        if self.__visualizedVolume != None and self.__clippingMarkupNode != None:
+            statistics = self.__logic.getHullStatistics(self.__visualizedVolume, self.__logic.getMarkupHull(self.__clippingMarkupNode))
+
+        if statistics == None:
+            self.__roiReadout.setText('')
+        elif statistics['voxels'] == 0:
+            self.__roiReadout.setText('Empty')
+        else:
+            self.__roiReadout.setText('%d voxels (%.2f mL), mean intensity %.1f, max intensity %.1f' % (statistics['voxels'], statistics['milliliters'], statistics['mean'], statistics['max']))
+
+    def buildModelSurface(self, request):
+
+        # Only builds polydata; the model node is updated in publishModelSurface.
+        return [request, self.__logic.buildModelSurface(request, self.__modelScheduler.isObsolete)]
+
+    def publishModelSurface(self, result):
+
+        self.__logic.setModelSurface(Helper.getNodeByID(result[0]['modelID']), result[1], result[0])
+
+    def onConcaveToggled(self, checked):
+
+        self.updateModelFromClippingMarkupNode()
 
     def onThresholdChanged(self): 
     
@@ -276,6 +363,11 @@ class ROIStep( SegmentationWizardStep ) :
                     self.__modelList.pop(ROI_idx)
                     pass
 
+        # Markups placed in the Registration step, to register within, become the first ROI.
+        registrationROINode = Helper.getNodeByID(pNode.GetParameter('registrationROINodeID'))
+        if self.__clippingMarkupSelector.currentNode() == None and registrationROINode != None and registrationROINode.IsA('vtkMRMLMarkupsFiducialNode'):
+            self.__clippingMarkupSelector.setCurrentNode(registrationROINode)
+
         pNode.SetParameter('currentStep', self.stepid)
         
         qt.QTimer.singleShot(0, self.killButton)
@@ -369,32 +461,98 @@ class ROIStep( SegmentationWizardStep ) :
 
             self.__outputList = []
 
-            # Currently, iterating over all ROI nodes is unnessecary, but in the future it would be helpful to save multiple models.
+            # Clipping must always use the smooth surface, never the raw hull shown while dragging.
+            self.__refineTimer.stop()
+            self.__modelScheduler.finish()
             for ROI_idx, ROI in enumerate(self.__markupList):
-                if ROI_idx == 0:
-
-                    if pNode.GetParameter('croppedVolumeID') == '' or pNode.GetParameter('croppedVolumeID') == None:
-                        outputVolume = slicer.vtkMRMLScalarVolumeNode()
-                        slicer.mrmlScene.AddNode(outputVolume)
-                    else:
-                        outputVolume = Helper.getNodeByID(pNode.GetParameter('croppedVolumeID'))
-
-                    Helper.SetLabelVolume(None)
+                self.__logic.updateModelFromMarkup(Helper.getNodeByID(ROI), Helper.getNodeByID(self.__modelList[ROI_idx]), concave=self.__concaveCheckBox.checked)
 
-                    # Crop volume to Convex ROI
-                    inputVolume = self.__visualizedVolume
-                    clippingModel = Helper.getNodeByID(self.__modelList[ROI_idx])
-                    clipOutsideSurface = True
-
-                    # Bit of an arbitrary value.. One less than the minimum of the image.
-                    self.__fillValue = inputVolume.GetImageData().GetScalarRange()[0] - 1
-
-                    self.__logic.clipVolumeWithModel(inputVolume, clippingModel, clipOutsideSurface, self.__fillValue, outputVolume)
-
-                    # I don't think OutputList is currently useful. The better tool would be to merge several models.
-                    self.__outputList.append(outputVolume.GetID())
-
-                    outputVolume.SetName(baselineVolume.GetName() + '_roi_cropped')
+            if pNode.GetParameter('croppedVolumeID') == '' or pNode.GetParameter('croppedVolumeID') == None:
+                outputVolume = slicer.vtkMRMLScalarVolumeNode()
+                slicer.mrmlScene.AddNode(outputVolume)
+            else:
+                outputVolume = Helper.getNodeByID(pNode.GetParameter('croppedVolumeID'))
+
+            Helper.SetLabelVolume(None)
+
+            # Crop volume to the union of all convex ROIs, in a single pass.
+            inputVolume = self.__visualizedVolume
+            markupNodes = [Helper.getNodeByID(ROI) for ROI in self.__markupList]
+            clippingModels = [Helper.getNodeByID(modelID) for modelID in self.__modelList]
+            clipOutsideSurface = True
+
+            # Bit of an arbitrary value.. One less than the minimum of the image.
+            self.__fillValue = inputVolume.GetImageData().GetScalarRange()[0] - 1
+
+            # The hull fast path needs at least four markups that are not all in one plane, for every ROI.
+            # Concave ROIs are not their hulls, so always clip with the models.
+            # A margin is added to the voxelized ROI, so neither fast path applies.
+            margin = self.__marginSpinBox.value
+            useHulls = self.__hullClipCheckBox.checked and not self.__concaveCheckBox.checked
+            clipped = False
+            if useHulls and margin == 0:
+                clipped = self.__logic.clipVolumeWithMarkupHulls(inputVolume, markupNodes, clipOutsideSurface, self.__fillValue, outputVolume, self.__cropCheckBox.checked)
+
+            clipVolumes = []
+            clipOutputs = []
+            if not clipped:
+                clipVolumes.append(inputVolume)
+                clipOutputs.append(outputVolume)
+
+            # Clipped copies of the other volumes are made anew each time.
+            croppedVolumeList = pNode.GetParameter('croppedVolumeList')
+            if croppedVolumeList == None:
+                croppedVolumeList = ''
+            for croppedID in croppedVolumeList.split('__'):
+                if croppedID != '':
+                    slicer.mrmlScene.RemoveNode(Helper.getNodeByID(croppedID))
+            croppedVolumeList = []
+
+            if self.__clipAllCheckBox.checked:
+                for volume in [baselineVolume, followupVolume]:
+                    if volume != None and volume.GetID() != inputVolume.GetID():
+                        croppedVolume = slicer.vtkMRMLScalarVolumeNode()
+                        croppedVolume.SetName(slicer.mrmlScene.GetUniqueNameByString(volume.GetName() + '_roi_cropped'))
+                        slicer.mrmlScene.AddNode(croppedVolume)
+                        clipVolumes.append(volume)
+                        clipOutputs.append(croppedVolume)
+                        croppedVolumeList.append(croppedVolume.GetID())
+
+            # Every volume is clipped with the same kind of mask as the visualized one:
+            # the exact hulls if they were used for it, otherwise the model surfaces.
+            fillValues = [volume.GetImageData().GetScalarRange()[0] - 1 for volume in clipVolumes]
+            roiMasks = []
+            if clipVolumes != [] and not clipped and margin != 0:
+                roiMasks = [self.__logic.getROIMask(volume, markupNodes, clippingModels, useHulls, margin) for volume in clipVolumes]
+
+            if clipVolumes != [] and clipped:
+                for volume, clipOutput, fillValue in zip(clipVolumes, clipOutputs, fillValues):
+                    self.__logic.clipVolumeWithMarkupHulls(volume, markupNodes, clipOutsideSurface, fillValue, clipOutput, self.__cropCheckBox.checked)
+            elif roiMasks != [] and all([mask is not None for mask, maskExtent in roiMasks]):
+                for volume, clipOutput, fillValue, (mask, maskExtent) in zip(clipVolumes, clipOutputs, fillValues, roiMasks):
+                    self.__logic.clipVolumeWithMask(volume, mask, maskExtent, clipOutsideSurface, fillValue, clipOutput, self.__cropCheckBox.checked)
+            elif clipVolumes != []:
+                # Without a margin, or when no ROI spans a volume and there is nothing to
+                # grow or shrink, the models are used as they are. Volumes on the same
+                # lattice share one stencil, and are clipped in parallel.
+                self.__logic.clipVolumesWithModels(clipVolumes, clippingModels, clipOutsideSurface, fillValues, clipOutputs, self.__cropCheckBox.checked)
+
+            pNode.SetParameter('croppedVolumeList', '__'.join(croppedVolumeList))
+
+            # I don't think OutputList is currently useful, now that all ROIs are merged into one volume.
+            self.__outputList.append(outputVolume.GetID())
+
+            outputVolume.SetName(baselineVolume.GetName() + '_roi_cropped')
+
+            # The components are taken from the same masks as the clip, margin included.
+            if self.__componentsCheckBox.checked:
+                masks = self.__logic.getROIComponentMasks(inputVolume, markupNodes, clippingModels, useHulls, margin)
+                if masks != []:
+                    componentsLabel = None
+                    if pNode.GetParameter('roiComponentsLabelID') != '' and pNode.GetParameter('roiComponentsLabelID') != None:
+                        componentsLabel = Helper.getNodeByID(pNode.GetParameter('roiComponentsLabelID'))
+                    componentsLabel = self.__logic.createComponentsLabel(inputVolume, masks, baselineVolume.GetName() + '_roi_components', componentsLabel)
+                    pNode.SetParameter('roiComponentsLabelID', componentsLabel.GetID())
 
             # Update parameter node. TODO: Consistent way to save lists to parameter node.
             pNode.SetParameter('clippingModelNodeID', self.__clippingModelNode.GetID())
@@ -403,23 +561,25 @@ class ROIStep( SegmentationWizardStep ) :
             pNode.SetParameter('markupList', '__'.join(self.__markupList))
             pNode.SetParameter('modelList', '__'.join(self.__modelList))
             pNode.SetParameter('croppedVolumeID', outputVolume.GetID())
+            pNode.SetParameter('clipFillValue', str(self.__fillValue))
 
-            # Get starting threshold parameters.
-            roiRange = outputVolume.GetImageData().GetScalarRange()
+            # Get starting threshold parameters. Only the ROI's bounding extent is scanned.
+            roiExtent = self.__logic.getROIExtent(outputVolume)
+            roiRange = self.__logic.getExtentScalarRange(outputVolume, roiExtent)
             pNode.SetParameter('intensityThreshRangeMin', str(roiRange[0]+1))
             pNode.SetParameter('intensityThreshRangeMax', str(roiRange[1]))
 
-            # Create a label node for segmentation. Should one make a new one each time? Who knows
-            vl = slicer.modules.volumes.logic()
+            # Create label nodes for segmentation. These only cover the ROI's bounding
+            # extent; ThresholdStep pads them to full size when they are needed for review.
 
             # Instantiate non-thresholded label.
             if pNode.GetParameter('nonThresholdedLabelID') == '' or pNode.GetParameter('nonThresholdedLabelID') == None:
-                roiSegmentation = vl.CreateLabelVolume(slicer.mrmlScene, outputVolume, baselineVolume.GetName() + '_roi_label')
+                roiSegmentation = self.__logic.createLabelVolume(outputVolume, roiExtent, baselineVolume.GetName() + '_roi_label')
                 pNode.SetParameter('nonThresholdedLabelID', roiSegmentation.GetID())
 
             # Instantiate thresholded label.
             if pNode.GetParameter('thresholdedLabelID') == '' or pNode.GetParameter('thresholdedLabelID') == None:
-                roiSegmentation = vl.CreateLabelVolume(slicer.mrmlScene, outputVolume, baselineVolume.GetName() + '_roi_label_thresholded')
+                roiSegmentation = self.__logic.createLabelVolume(outputVolume, roiExtent, baselineVolume.GetName() + '_roi_label_thresholded')
                 pNode.SetParameter('thresholdedLabelID', roiSegmentation.GetID())
 
             # Remove node observers, so that models don't get updated outside of the module.
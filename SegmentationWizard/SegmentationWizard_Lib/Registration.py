@@ -1,11 +1,17 @@
 """ This is Step 2. The user has the option to register their pre- and post-contrast images
-	using the module BRAINSFit. TO-DO: add a progress bar.
+	using the module BRAINSFit.
 """
 
-from __main__ import qt, ctk, slicer
+from __main__ import vtk, qt, ctk, slicer
 
 from SegmentationWizardStep import *
 from Helper import *
+from RegistrationLogic import *
+from RegistrationMetrics import *
+from VolumeClipWithModel import VolumeClipWithModelLogic
+
+import os
+import time
 
 """ RegistrationStep inherits from SegmentationWizardStep, with itself inherits
 	from a ctk workflow class. 
@@ -21,6 +27,37 @@ class RegistrationStep( SegmentationWizardStep ) :
 		self.__parent = super( RegistrationStep, self )
 
 		self.__status = "Uncalled"
+
+		# Wall-clock seconds of the last registration run by each engine, so they can be compared.
+		self.__registrationTimes = {}
+
+		self.__registrationJob = None
+
+		self.__clipLogic = VolumeClipWithModelLogic()
+
+		# Automatic registration tries these transform types in turn, until the
+		# registered volume correlates well enough with the fixed volume.
+		self.__metrics = RegistrationMetrics()
+		self.__escalationTransformTypes = []
+		self.__escalationScores = []
+
+		# When automatic registration replaces the moving volume, the stages
+		# write to a scratch volume, and this is the volume to replace at the end.
+		self.__replacedVolume = None
+
+		# The parameters of the registration running, or last run, and the geometry
+		# of its moving volume before registration.
+		self.__registrationParameters = None
+		self.__movingGeometry = None
+		self.__waitForCompletion = False
+
+		# Deformable registration restricted to the ROI, and a summary of its last run.
+		self.__regionRegistration = None
+		self.__regionReport = None
+		self.__regionExtent = None
+
+		self.__registrationCache = RegistrationCache(os.path.join(slicer.app.temporaryPath, 'SegmentationWizard', 'RegistrationCache'))
+		self.__pendingCacheEntry = None
 	
 	def createUserInterface( self ):
 		
@@ -84,6 +121,73 @@ class RegistrationStep( SegmentationWizardStep ) :
 		self.__RegistrationRadio4.toolTip = """Computes a BSpline Registration on the pre-contrast image with respect to the post-contrast image. This method is slowest and may be necessary for only severly distorted images."""
 		RegistrationGroupBoxLayout.addRow(self.__RegistrationRadio4)
 
+		self.__RegistrationRadio5 = qt.QRadioButton("Automatic Registration")
+		self.__RegistrationRadio5.toolTip = """Starts with a rigid registration, and only goes on to affine and then deformable registration while the registered image still correlates poorly with the fixed image. Most pairs of images finish at the fast rigid stage."""
+		RegistrationGroupBoxLayout.addRow(self.__RegistrationRadio5)
+
+		self.__EscalationSpinBox = qt.QDoubleSpinBox()
+		self.__EscalationSpinBox.setRange(0, 1)
+		self.__EscalationSpinBox.setSingleStep(0.01)
+		self.__EscalationSpinBox.setDecimals(2)
+		self.__EscalationSpinBox.setValue(0.9)
+		self.__EscalationSpinBox.setToolTip("In automatic registration, a more flexible transform is tried when the correlation between the registered and fixed images is below this value.")
+		RegistrationGroupBoxLayout.addRow("Escalate Below Correlation: ", self.__EscalationSpinBox)
+
+		self.__RegionCheckBox = qt.QCheckBox("Register deformably within the ROI only")
+		self.__RegionCheckBox.toolTip = "Crops both images to the registration ROI below, with its padding, before deformable registration, and resamples them more coarsely if they would still need more memory than the limit. The deformation found is then applied to the whole image. It is zero outside the crop, so the result may be discontinuous at the crop border. Only used when a BSpline registration runs, alone or in automatic registration."
+		RegistrationGroupBoxLayout.addRow(self.__RegionCheckBox)
+
+		self.__MemorySpinBox = qt.QSpinBox()
+		self.__MemorySpinBox.setRange(256, 65536)
+		self.__MemorySpinBox.setSingleStep(256)
+		self.__MemorySpinBox.setSuffix(' MB')
+		self.__MemorySpinBox.setValue(4096)
+		self.__MemorySpinBox.setToolTip("The memory to aim for in deformable registration within the ROI. The cropped images are resampled more coarsely until their estimated memory use is below it. This is not a limit: registration is not stopped if it uses more.")
+		RegistrationGroupBoxLayout.addRow("Deformable Memory Target: ", self.__MemorySpinBox)
+
+		self.__InProcessCheckBox = qt.QCheckBox("Register in-process")
+		self.__InProcessCheckBox.toolTip = "Runs rigid and affine registration inside Slicer, on the images in memory, instead of calling BRAINSFit. This skips writing the images to disk and reading them back. Deformable registration always uses BRAINSFit."
+		self.__InProcessCheckBox.setEnabled(InProcessRegistration.isAvailable())
+		RegistrationGroupBoxLayout.addRow(self.__InProcessCheckBox)
+
+		self.__CacheCheckBox = qt.QCheckBox("Reuse earlier results")
+		self.__CacheCheckBox.toolTip = "Restores the result of an earlier registration of the same volumes with the same settings, including one from a previous session, instead of running it again. BSpline registrations are always run."
+		self.__CacheCheckBox.setChecked(True)
+		RegistrationGroupBoxLayout.addRow(self.__CacheCheckBox)
+
+		# Registration ROI Options
+
+		ROIGroupBox = qt.QGroupBox()
+		ROIGroupBox.setTitle('Registration ROI')
+		self.__layout.addRow(ROIGroupBox)
+
+		ROIGroupBoxLayout = qt.QFormLayout(ROIGroupBox)
+
+		self.__ROICheckBox = qt.QCheckBox("Register within an ROI")
+		self.__ROICheckBox.toolTip = "Only aligns the images around an ROI, instead of over the whole scan. Sampling fewer voxels over a smaller region is faster, and more accurate around the lesion."
+		ROIGroupBoxLayout.addRow(self.__ROICheckBox)
+
+		self.__ROISelector = slicer.qMRMLNodeComboBox()
+		self.__ROISelector.nodeTypes = ("vtkMRMLMarkupsFiducialNode", "vtkMRMLModelNode", "vtkMRMLAnnotationROINode")
+		self.__ROISelector.addEnabled = True
+		self.__ROISelector.removeEnabled = False
+		self.__ROISelector.noneEnabled = True
+		self.__ROISelector.showHidden = False
+		self.__ROISelector.renameEnabled = True
+		self.__ROISelector.baseName = "Markup"
+		self.__ROISelector.setMRMLScene(slicer.mrmlScene)
+		self.__ROISelector.setToolTip("Markups around the region to align, a previous ROI model, or a box. Markups placed here are offered again in the ROI step.")
+		ROIGroupBoxLayout.addRow("ROI: ", self.__ROISelector)
+
+		self.__ROIPaddingSpinBox = qt.QDoubleSpinBox()
+		self.__ROIPaddingSpinBox.setRange(0, 100)
+		self.__ROIPaddingSpinBox.setSingleStep(1)
+		self.__ROIPaddingSpinBox.setDecimals(1)
+		self.__ROIPaddingSpinBox.setSuffix(' mm')
+		self.__ROIPaddingSpinBox.setValue(10)
+		self.__ROIPaddingSpinBox.setToolTip("Grow the ROI by this distance, so that the tissue around the lesion guides the alignment too.")
+		ROIGroupBoxLayout.addRow("ROI Padding: ", self.__ROIPaddingSpinBox)
+
 		# Output Volume Preference
 
 		OutputGroupBox = qt.QGroupBox()
@@ -113,8 +217,23 @@ class RegistrationStep( SegmentationWizardStep ) :
 		self.__registrationStatus = qt.QLabel('Register scans')
 		self.__registrationStatus.alignment = 4 # This codes for centered alignment, although I'm not sure why.
 		RunGroupBoxLayout.addRow(self.__registrationStatus)
-		RunGroupBoxLayout.addRow(self.__registrationButton)
+
+		self.__registrationProgress = qt.QProgressBar()
+		self.__registrationProgress.setRange(0, 100)
+		self.__registrationProgress.hide()
+		RunGroupBoxLayout.addRow(self.__registrationProgress)
+
+		self.__threadsSpinBox = qt.QSpinBox()
+		self.__threadsSpinBox.setRange(0, qt.QThread.idealThreadCount())
+		self.__threadsSpinBox.setSpecialValueText('All')
+		self.__threadsSpinBox.toolTip = "The number of cores registration may use. Lower this to leave cores free on a shared workstation."
+		RunGroupBoxLayout.addRow('Threads: ', self.__threadsSpinBox)
+
+		self.__cancelButton = qt.QPushButton('Cancel')
+		self.__cancelButton.setEnabled(0)
+		RunGroupBoxLayout.addRow(self.__registrationButton, self.__cancelButton)
 		self.__registrationButton.connect('clicked()', self.onRegistrationRequest)
+		self.__cancelButton.connect('clicked()', self.onCancelRequest)
 
 	def killButton(self):
 
@@ -161,6 +280,14 @@ class RegistrationStep( SegmentationWizardStep ) :
 		pNode.SetParameter('currentStep', self.stepid)
 		Helper.SetBgFgVolumes(pNode.GetParameter('baselineVolumeID'),pNode.GetParameter('followupVolumeID'))
 
+		# Offer an ROI drawn in an earlier pass through the wizard.
+		if self.__ROISelector.currentNode() == None:
+			for parameter in ['registrationROINodeID', 'clippingMarkupNodeID', 'clippingModelNodeID']:
+				roiNode = Helper.getNodeByID(pNode.GetParameter(parameter))
+				if roiNode != None:
+					self.__ROISelector.setCurrentNode(roiNode)
+					break
+
 		# A different attempt to get rid of the extra workflow button.
 		qt.QTimer.singleShot(0, self.killButton)
 
@@ -173,13 +300,16 @@ class RegistrationStep( SegmentationWizardStep ) :
 		""" This method makes a call to a different slicer module, BRAINSFIT. 
 			Note that this registration method computes a transform, which is 
 			then applied to the followup volume in processRegistrationCompletion. 
-			TO-DO: Add a cancel button and a progress bar.
 		"""
 		if self.__RegistrationRadio1.isChecked():
 			return
 		else:
 			pNode = self.parameterNode()
 
+			for metric in ['NCC', 'MI', 'MAD']:
+				pNode.SetParameter('registration' + metric, '')
+			self.__regionReport = None
+
 			# Registration Order Options
 			if self.__OrderRadio1.isChecked():
 				fixedVolumeID = pNode.GetParameter('originalFollowupVolumeID')
@@ -191,6 +321,9 @@ class RegistrationStep( SegmentationWizardStep ) :
 			fixedVolume = Helper.getNodeByID(fixedVolumeID)
 			movingVolume = Helper.getNodeByID(movingVolumeID)
 
+			# The scores only look at where the moving volume overlaps the fixed one.
+			self.__movingGeometry = self.__metrics.getGeometry(movingVolume)
+
 			parameters = {}
 			parameters["fixedVolume"] = fixedVolume
 			parameters["movingVolume"] = movingVolume
@@ -217,6 +350,15 @@ class RegistrationStep( SegmentationWizardStep ) :
 				slicer.mrmlScene.AddNode(self.__BSplineTransform)
 				pNode.SetParameter('registrationTransformID', self.__BSplineTransform.GetID())
 				parameters['transformType'] = 'BSpline'
+			elif self.__RegistrationRadio5.isChecked():
+				pNode.SetParameter('registrationTransformID', self.__LinearTransform.GetID())
+				parameters['transformType'] = 'Rigid'
+
+			if self.__RegistrationRadio5.isChecked():
+				self.__escalationTransformTypes = ['Rigid,ScaleVersor3D,ScaleSkewVersor3D,Affine', 'BSpline']
+			else:
+				self.__escalationTransformTypes = []
+			self.__escalationScores = []
 
 			# Output options. TODO: Make this section a bit more logical.
 			if self.__OutputRadio2.isChecked():
@@ -240,31 +382,299 @@ class RegistrationStep( SegmentationWizardStep ) :
 					pNode.SetParameter('originalFollowupVolumeID', movingVolumeID)
 				parameters['outputVolume'] = registrationVolume
 
-			self.__cliNode = None
-			self.__cliNode = slicer.cli.run(slicer.modules.brainsfit, self.__cliNode, parameters, wait_for_completion=wait_for_completion)
+			# Every stage of automatic registration registers the original moving
+			# volume, so it is only replaced once the last stage is done.
+			self.discardScratchVolume()
+			if self.__escalationTransformTypes != [] and parameters['outputVolume'] == movingVolume:
+				self.__replacedVolume = movingVolume
+				parameters['outputVolume'] = slicer.vtkMRMLScalarVolumeNode()
+				parameters['outputVolume'].SetName(slicer.mrmlScene.GetUniqueNameByString(movingVolume.GetName() + '_stage'))
+				slicer.mrmlScene.AddNode(parameters['outputVolume'])
+
+			# The ROI gives both the masks, when registering within it, and the region
+			# deformable registration is cropped to, which is only needed when a BSpline
+			# stage will run. Either can be used without the other.
+			regionNeeded = self.__RegionCheckBox.isChecked() and (self.__RegistrationRadio4.isChecked() or self.__RegistrationRadio5.isChecked())
+			roiMask, roiExtent = None, None
+			if self.__ROICheckBox.isChecked() or regionNeeded:
+				roiNode = self.__ROISelector.currentNode()
+				roiMask, roiExtent = self.voxelizeRegistrationROI(roiNode, fixedVolume)
+				if roiMask is None or not roiMask.any():
+					Helper.ErrorPopup('Please choose an ROI model, a box, or at least four markups around a region, to register within.')
+					return
+				pNode.SetParameter('registrationROINodeID', roiNode.GetID())
+
+			self.__regionExtent = roiExtent if regionNeeded else None
+
+			self.removeRegistrationMasks()
+			if self.__ROICheckBox.isChecked():
+				maskVolumes = self.updateRegistrationMask(fixedVolume, movingVolume, roiMask, roiExtent)
+				parameters['maskProcessingMode'] = 'ROI'
+				parameters['fixedBinaryVolume'] = maskVolumes[0]
+				if maskVolumes[1] != None:
+					parameters['movingBinaryVolume'] = maskVolumes[1]
+
+			self.runRegistration(parameters, wait_for_completion)
+
+	def runRegistration(self, parameters, wait_for_completion=False):
+
+		""" Runs a single registration with the BRAINSFit parameters given, or
+			restores its result from the cache. onStageCompleted follows.
+		"""
+
+		self.__registrationParameters = parameters
+		self.__waitForCompletion = wait_for_completion
+
+		if parameters['transformType'] == 'BSpline':
+			parameters['bsplineTransform'] = self.__BSplineTransform
+		else:
+			parameters['linearTransform'] = self.__LinearTransform
+
+		inProcess = self.__InProcessCheckBox.isChecked() and InProcessRegistration.supportsTransformType(parameters['transformType'])
+
+		# BRAINSFit registers the cropped volumes, and the result is resampled
+		# into the original output volume when it completes.
+		jobParameters = parameters
+		if parameters['transformType'] == 'BSpline' and self.__RegionCheckBox.isChecked():
+			self.__regionRegistration = RegionRegistration(self.__MemorySpinBox.value)
+			jobParameters = self.__regionRegistration.prepare(parameters, self.__regionExtent)
+
+		# The key is taken before registering, as the moving volume may be the output.
+		# The cache only keeps linear transforms, so BSpline runs are not cached;
+		# a restored volume would come without its deformation field.
+		cacheKey = None
+		if self.__CacheCheckBox.isChecked() and parameters['transformType'] != 'BSpline':
+			startTime = time.time()
+			cacheKey = self.__registrationCache.getKey(jobParameters, 'in-process' if inProcess else 'BRAINSFit')
+			if self.__registrationCache.restore(cacheKey, parameters):
+				self.__registrationTimes['cached'] = time.time() - startTime
+				if self.__regionRegistration != None:
+					self.__regionRegistration.finish(False)
+					self.__regionRegistration = None
+				self.onStageCompleted()
+				return
+
+		self.__pendingCacheEntry = None if cacheKey == None else [cacheKey, parameters]
+
+		self.__status = 'Running'
+		self.__registrationStatus.setText('Wait ...')
+		self.__registrationProgress.setValue(0)
+		self.__registrationProgress.show()
+		self.__registrationButton.setEnabled(0)
+		self.__cancelButton.setEnabled(1)
+
+		threads = self.__threadsSpinBox.value if self.__threadsSpinBox.value > 0 else -1
+		self.__registrationJob = RegistrationJob(self.processRegistrationProgress, self.processRegistrationCompletion, threads)
+		self.__registrationJob.start(jobParameters, inProcess, wait_for_completion)
+
+	def updateRegistrationMask(self, fixedVolume, movingVolume, mask, extent):
+
+		""" Stores the chosen ROI, voxelized on the fixed lattice as [mask, extent],
+			in a label volume, and voxelizes it again into one on the moving
+			lattice, for use as the fixed- and moving-image masks. Returns the two
+			label volumes; the moving one is None if the ROI misses the moving volume.
+		"""
+
+		pNode = self.parameterNode()
+		roiNode = self.__ROISelector.currentNode()
+
+		maskVolume = self.createRegistrationMaskVolume(fixedVolume, mask, extent)
+		pNode.SetParameter('registrationMaskID', maskVolume.GetID())
+
+		# The volumes are assumed to roughly line up already, as when the moving
+		# volume is cropped for region registration.
+		movingMaskVolume = None
+		movingMask, movingExtent = self.voxelizeRegistrationROI(roiNode, movingVolume)
+		if movingMask is not None and movingMask.any():
+			movingMaskVolume = self.createRegistrationMaskVolume(movingVolume, movingMask, movingExtent)
+			pNode.SetParameter('registrationMovingMaskID', movingMaskVolume.GetID())
+
+		return [maskVolume, movingMaskVolume]
+
+	def removeRegistrationMasks(self):
+
+		pNode = self.parameterNode()
+		for parameter in ['registrationMaskID', 'registrationMovingMaskID']:
+			slicer.mrmlScene.RemoveNode(Helper.getNodeByID(pNode.GetParameter(parameter)))
+			pNode.SetParameter(parameter, '')
+
+	def voxelizeRegistrationROI(self, roiNode, volume):
+
+		""" Returns the mask of the chosen ROI, grown by the padding, on the
+			lattice of volume, and its extent. The mask is None if the ROI
+			cannot be used.
+		"""
+
+		if roiNode != None and roiNode.IsA('vtkMRMLMarkupsFiducialNode'):
+			if self.__clipLogic.getMarkupHull(roiNode).isValid():
+				return self.__clipLogic.getROIMask(volume, [roiNode], [], True, self.__ROIPaddingSpinBox.value)
+		elif roiNode != None and roiNode.IsA('vtkMRMLModelNode') and roiNode.GetPolyData() != None and roiNode.GetPolyData().GetNumberOfPoints() > 0:
+			return self.__clipLogic.getROIMask(volume, [], [roiNode], False, self.__ROIPaddingSpinBox.value)
+		elif roiNode != None and roiNode.IsA('vtkMRMLAnnotationROINode'):
+			center = [0, 0, 0]
+			radius = [0, 0, 0]
+			roiNode.GetXYZ(center)
+			roiNode.GetRadiusXYZ(radius)
+			return self.__clipLogic.getBoxMask(volume, center, [r + self.__ROIPaddingSpinBox.value for r in radius])
+
+		return [None, None]
+
+	def createRegistrationMaskVolume(self, volume, mask, extent):
+
+		maskVolume = self.__clipLogic.createLabelVolume(volume, extent, volume.GetName() + '_registration_mask')
+		self.__clipLogic.getExtentArray(maskVolume.GetImageData())[:] = mask
+		maskVolume.GetImageData().Modified()
+		self.__clipLogic.padLabelToVolume(maskVolume, volume, extent)
 
-			# An event listener for the CLI. TODO: Add a progress bar.
-			self.__cliObserverTag = self.__cliNode.AddObserver('ModifiedEvent', self.processRegistrationCompletion)
-			self.__registrationStatus.setText('Wait ...')
-			self.__registrationButton.setEnabled(0)
+		return maskVolume
 
-	def processRegistrationCompletion(self, node, event):
+	def onCancelRequest(self):
+
+		if self.__registrationJob != None and self.__registrationJob.isRunning():
+			self.__registrationStatus.setText('Cancelling ...')
+			self.__registrationJob.cancel()
+
+	def processRegistrationProgress(self, status, progress):
+
+		self.__registrationStatus.setText('Registration ' + status)
+		self.__registrationProgress.setValue(int(progress))
+
+	def processRegistrationCompletion(self, status):
 
 		""" This updates the registration button with the CLI module's convenient status
 			indicator. Upon completion, it applies the transform to the followup node.
 			Furthermore, it sets the followup node to be the baseline node in the viewer.
 		"""
 
-		self.__status = node.GetStatusString()
-		self.__registrationStatus.setText('Registration ' + self.__status)
+		job = self.__registrationJob
+		self.__registrationJob = None
+
+		if self.__regionRegistration != None:
+			self.__regionRegistration.finish(status == 'Completed')
+			if status == 'Completed':
+				region = self.__regionRegistration
+				self.__regionReport = 'Deformable region %dx%dx%d voxels (downsampled %.2gx), estimated memory %d MB for a %d MB target' % (tuple(region.regionDimensions) + (region.downsamplingFactor, region.estimatedMemory, region.memoryTarget))
+				self.__regionReport += ', BRAINSFit peak ' + ('unknown' if region.peakMemory == None else '%d MB' % region.peakMemory)
+				self.__regionReport += '. The deformation stops at the region border, so the result may show a seam there'
+			self.__regionRegistration = None
+
+		self.__registrationProgress.hide()
+		self.__cancelButton.setEnabled(0)
+		self.__registrationButton.setEnabled(1)
+
+		if status == 'Completed':
+			self.__registrationTimes[job.engine] = job.elapsedTime
+			if self.__pendingCacheEntry != None:
+				self.__registrationCache.store(*self.__pendingCacheEntry)
+				self.__pendingCacheEntry = None
+			self.onStageCompleted()
+		else:
+			# A cancelled or failed registration can simply be run again.
+			self.__status = 'Uncalled'
+			self.__pendingCacheEntry = None
+			self.discardScratchVolume()
+			self.__registrationStatus.setText('Registration ' + status)
+
+	def onStageCompleted(self):
 
-		if self.__status == 'Completed':
-			self.__registrationButton.setEnabled(1)
+		""" In automatic registration, scores the alignment and moves on to the
+			next transform type if it is still poor. Otherwise registration is done.
+		"""
 
-			pNode = self.parameterNode()
+		if self.__escalationTransformTypes != []:
+			parameters = self.__registrationParameters
+			score = self.__metrics.normalizedCrossCorrelation(parameters['fixedVolume'], parameters['outputVolume'], self.__movingGeometry, self.getRegistrationTransform(parameters))
+			self.__escalationScores.append('%s %s' % (parameters['transformType'].split(',')[-1], 'n/a' if score == None else '%.3f' % score))
+			if score == None or score < self.__EscalationSpinBox.value:
+				self.escalateRegistration()
+				return
 
-			if self.__OrderRadio1.isChecked():
-				Helper.SetBgFgVolumes(pNode.GetParameter('followupVolumeID'), pNode.GetParameter('registrationVolumeID'))
-			else:
-				Helper.SetBgFgVolumes(pNode.GetParameter('registrationVolumeID'), pNode.GetParameter('baselineVolumeID'))
+		if self.__replacedVolume != None:
+			self.replaceMovingVolume()
+
+		self.__status = 'Completed'
+		self.onRegistrationCompleted()
+
+	def escalateRegistration(self):
+
+		""" Registers again with the next, more flexible, transform type. """
+
+		pNode = self.parameterNode()
+
+		parameters = dict(self.__registrationParameters)
+		parameters['transformType'] = self.__escalationTransformTypes.pop(0)
+		parameters.pop('linearTransform', None)
+
+		# The original moving volume is registered again, starting from where
+		# the previous, linear, stage left it.
+		parameters['initialTransform'] = self.__LinearTransform
+		parameters['initializeTransformMode'] = 'Off'
+
+		if parameters['transformType'] == 'BSpline':
+			self.__BSplineTransform = slicer.vtkMRMLBSplineTransformNode()
+			slicer.mrmlScene.AddNode(self.__BSplineTransform)
+			pNode.SetParameter('registrationTransformID', self.__BSplineTransform.GetID())
+
+		self.runRegistration(parameters, self.__waitForCompletion)
+
+	@staticmethod
+	def getRegistrationTransform(parameters):
+
+		if parameters['transformType'] == 'BSpline':
+			return parameters['bsplineTransform']
+		return parameters['linearTransform']
+
+	def replaceMovingVolume(self):
+
+		""" Moves the result of automatic registration from the scratch volume
+			into the moving volume, which it replaces.
+		"""
+
+		parameters = self.__registrationParameters
+		scratchVolume = parameters['outputVolume']
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		scratchVolume.GetIJKToRASMatrix(ijkToRas)
+		self.__replacedVolume.SetIJKToRASMatrix(ijkToRas)
+		self.__replacedVolume.SetAndObserveImageData(scratchVolume.GetImageData())
+
+		parameters['outputVolume'] = self.__replacedVolume
+		self.__replacedVolume = None
+		slicer.mrmlScene.RemoveNode(scratchVolume)
+
+	def discardScratchVolume(self):
+
+		# The moving volume is left as it was.
+		if self.__replacedVolume != None:
+			slicer.mrmlScene.RemoveNode(self.__registrationParameters['outputVolume'])
+			self.__replacedVolume = None
+
+	def onRegistrationCompleted(self):
+
+		""" Scores the registration, reports the time taken by each registration
+			engine run so far, and shows the registered volume over the fixed volume.
+		"""
+
+		pNode = self.parameterNode()
+
+		# Stored for batch quality checks, as registrationNCC, registrationMI and registrationMAD.
+		parameters = self.__registrationParameters
+		scores = self.__metrics.getScores(parameters['fixedVolume'], parameters['outputVolume'], self.__movingGeometry, self.getRegistrationTransform(parameters))
+		for metric in ['NCC', 'MI', 'MAD']:
+			pNode.SetParameter('registration' + metric, '' if scores[metric] == None else '%.6g' % scores[metric])
+
+		timings = ['%s %.1f s' % (engine, self.__registrationTimes[engine]) for engine in sorted(self.__registrationTimes.keys())]
+		self.__registrationStatus.setText('Registration Completed (' + ', '.join(timings) + ')')
+		self.__registrationStatus.setText(self.__registrationStatus.text + '\n' + ', '.join(['%s %s' % (metric, pNode.GetParameter('registration' + metric) or 'n/a') for metric in ['NCC', 'MI', 'MAD']]))
+		if self.__escalationScores != []:
+			self.__registrationStatus.setText(self.__registrationStatus.text + '\nCorrelation after ' + ', '.join(self.__escalationScores))
+		if self.__regionReport != None:
+			self.__registrationStatus.setText(self.__registrationStatus.text + '\n' + self.__regionReport)
+
+		self.__registrationButton.setEnabled(1)
+
+		if self.__OrderRadio1.isChecked():
+			Helper.SetBgFgVolumes(pNode.GetParameter('followupVolumeID'), pNode.GetParameter('registrationVolumeID'))
+		else:
+			Helper.SetBgFgVolumes(pNode.GetParameter('registrationVolumeID'), pNode.GetParameter('baselineVolumeID'))
 
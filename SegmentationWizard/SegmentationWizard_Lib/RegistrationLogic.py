@@ -0,0 +1,815 @@
+""" This file runs the registrations of Step 2. Rigid and affine registration
+	can run in-process with SimpleITK, taking the same parameters as the
+	BRAINSFit call, when SimpleITK is available. It also holds the cache of
+	earlier results, and the cropping used for deformable registration of a
+	region.
+"""
+
+from __main__ import vtk, slicer
+
+from Helper import *
+
+import collections
+import hashlib
+import json
+import math
+import numpy
+import os
+import sys
+import time
+from vtk.util import numpy_support
+
+try:
+	import SimpleITK as sitk
+except ImportError:
+	sitk = None
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+class InProcessRegistration( object ):
+
+	""" Registers a moving volume to a fixed volume with SimpleITK, without
+		leaving the process. Parameters are given as a dictionary with the
+		keys of the BRAINSFit call in RegistrationStep: fixedVolume,
+		movingVolume, outputVolume, transformType, samplingPercentage,
+		initializeTransformMode and optionally linearTransform,
+		initialTransform, and
+		maskProcessingMode with fixedBinaryVolume and movingBinaryVolume.
+		Only linear transform types are supported.
+	"""
+
+	# Each level of the pyramid shrinks the images by these factors, and
+	# blurs them by these sigmas in mm first.
+	shrinkFactors = [4, 2, 1]
+	smoothingSigmas = [2.0, 1.0, 0.0]
+
+	@staticmethod
+	def isAvailable():
+
+		return sitk != None
+
+	@staticmethod
+	def supportsTransformType( transformType ):
+
+		return 'BSpline' not in transformType.split(',')
+
+	def __init__( self ):
+
+		self.numberOfIterations = 100
+		self.numberOfHistogramBins = 50
+
+		# -1 uses all cores. progressCallback, if set, is called with the
+		# percentage done after every iteration of the optimizer.
+		self.numberOfThreads = -1
+		self.progressCallback = None
+
+		self.__cancelled = False
+		self.__method = None
+
+	def cancel( self ):
+
+		""" Stops the registration after the current iteration. Meant to be
+			called from progressCallback, or from an event it processes.
+		"""
+
+		self.__cancelled = True
+		if self.__method != None:
+			self.__method.StopRegistration()
+
+	def run( self, parameters ):
+
+		""" Registers, writes the resampled moving volume into outputVolume
+			and the transform into linearTransform if given. Returns the
+			wall-clock time taken in seconds, or None if it was cancelled, in
+			which case the volumes are left as they were.
+		"""
+
+		startTime = time.time()
+
+		fixedVolume = parameters['fixedVolume']
+		movingVolume = parameters['movingVolume']
+
+		fixedImage = self.volumeToImage(fixedVolume)
+		movingImage = self.volumeToImage(movingVolume)
+
+		fixedMask = None
+		movingMask = None
+		if parameters.get('maskProcessingMode') == 'ROI':
+			if parameters.get('fixedBinaryVolume') != None:
+				fixedMask = self.volumeToImage(parameters['fixedBinaryVolume']) > 0
+			if parameters.get('movingBinaryVolume') != None:
+				movingMask = self.volumeToImage(parameters['movingBinaryVolume']) > 0
+
+		initialTransform = None
+		if parameters.get('initialTransform') != None:
+			initialMatrix = vtk.vtkMatrix4x4()
+			parameters['initialTransform'].GetMatrixTransformFromParent(initialMatrix)
+			initialTransform = self.matrixToTransform(initialMatrix)
+
+		transform = self.register(fixedImage, movingImage, parameters['transformType'], parameters['samplingPercentage'], parameters['initializeTransformMode'], fixedMask, movingMask, initialTransform)
+		if self.__cancelled:
+			return None
+
+		self.resampleToVolume(movingVolume, movingImage, fixedVolume, fixedImage, transform, parameters['outputVolume'])
+
+		if parameters.get('linearTransform') != None:
+			parameters['linearTransform'].SetMatrixTransformFromParent(self.transformToMatrix(transform))
+
+		return time.time() - startTime
+
+	def register( self, fixedImage, movingImage, transformType, samplingPercentage, initializeTransformMode, fixedMask=None, movingMask=None, initialTransform=None ):
+
+		""" Returns the SimpleITK transform that maps points of the fixed image
+			onto the moving image. Affine registration starts from the rigid
+			result, as BRAINSFit does for its list of transform types. With a
+			fixedMask, only fixed voxels inside it are sampled, and the fixed
+			image is cropped to the mask before optimizing. With a movingMask,
+			fixed samples that map outside it are left out as well. With an
+			initialTransform, the rigid stage starts from the rotation nearest
+			to it, and initializeTransformMode is not used.
+		"""
+
+		rigid = sitk.Euler3DTransform()
+		if initialTransform != None:
+			rigid = self.nearestRigidTransform(initialTransform, fixedImage)
+		elif initializeTransformMode == 'useMomentsAlign':
+			rigid = sitk.Euler3DTransform(sitk.CenteredTransformInitializer(fixedImage, movingImage, rigid, sitk.CenteredTransformInitializerFilter.MOMENTS))
+		elif initializeTransformMode != 'Off':
+			rigid = sitk.Euler3DTransform(sitk.CenteredTransformInitializer(fixedImage, movingImage, rigid, sitk.CenteredTransformInitializerFilter.GEOMETRY))
+
+		# The initialization above still looks at the whole images, so that
+		# their centers or moments correspond.
+		if fixedMask != None:
+			fixedImage, fixedMask = self.cropToMask(fixedImage, fixedMask)
+
+		numberOfStages = 2 if 'Affine' in transformType.split(',') else 1
+
+		self.optimize(fixedImage, movingImage, rigid, samplingPercentage, 0, numberOfStages, fixedMask, movingMask)
+
+		if numberOfStages == 1 or self.__cancelled:
+			return rigid
+
+		affine = sitk.AffineTransform(3)
+		affine.SetCenter(rigid.GetCenter())
+		affine.SetMatrix(rigid.GetMatrix())
+		affine.SetTranslation(rigid.GetTranslation())
+
+		self.optimize(fixedImage, movingImage, affine, samplingPercentage, 1, numberOfStages, fixedMask, movingMask)
+
+		return affine
+
+	def optimize( self, fixedImage, movingImage, transform, samplingPercentage, stage=0, numberOfStages=1, fixedMask=None, movingMask=None ):
+
+		""" Optimizes transform in place by Mattes mutual information over the
+			pyramid, coarsest level first. stage and numberOfStages place this
+			optimization within the whole run, for progress reporting.
+		"""
+
+		method = self.createRegistrationMethod(samplingPercentage)
+		method.SetInitialTransform(transform, True)
+		if fixedMask != None:
+			method.SetMetricFixedMask(fixedMask)
+		if movingMask != None:
+			method.SetMetricMovingMask(movingMask)
+		if self.progressCallback != None:
+			method.AddCommand(sitk.sitkIterationEvent, lambda: self.reportProgress(method, stage, numberOfStages))
+
+		self.__method = method
+		try:
+			method.Execute(fixedImage, movingImage)
+		finally:
+			self.__method = None
+
+	def reportProgress( self, method, stage, numberOfStages ):
+
+		# Stopping only ends the current level of the pyramid.
+		if self.__cancelled:
+			method.StopRegistration()
+			return
+
+		numberOfLevels = len(self.shrinkFactors)
+		iteration = min(method.GetOptimizerIteration(), self.numberOfIterations)
+		done = stage * numberOfLevels + method.GetCurrentLevel() + float(iteration) / self.numberOfIterations
+		self.progressCallback(100.0 * done / (numberOfStages * numberOfLevels))
+
+	def cropToMask( self, image, mask ):
+
+		""" Returns [image, mask] cropped to the bounding box of the mask, which
+			should share the image's lattice, padded so that the coarsest level
+			of the pyramid still sees some of the surroundings. An empty mask
+			is dropped.
+		"""
+
+		array = sitk.GetArrayFromImage(mask)
+		if not array.any():
+			return [image, None]
+		if mask.GetSize() != image.GetSize():
+			return [image, mask]
+
+		padding = 2 * max(self.shrinkFactors)
+		size = image.GetSize()
+		lower, upper = [], []
+		for axis in range(3):
+			indices = numpy.nonzero(array.any(axis=tuple(other for other in range(3) if other != 2 - axis)))[0]
+			lower.append(max(int(indices[0]) - padding, 0))
+			upper.append(min(int(indices[-1]) + padding + 1, size[axis]))
+
+		return [image[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]],
+				mask[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]]]
+
+	def createRegistrationMethod( self, samplingPercentage ):
+
+		method = sitk.ImageRegistrationMethod()
+		method.SetMetricAsMattesMutualInformation(self.numberOfHistogramBins)
+		method.SetMetricSamplingStrategy(method.RANDOM)
+		method.SetMetricSamplingPercentage(samplingPercentage)
+		method.SetInterpolator(sitk.sitkLinear)
+		method.SetOptimizerAsRegularStepGradientDescent(1.0, 1e-4, self.numberOfIterations)
+		method.SetOptimizerScalesFromPhysicalShift()
+		method.SetShrinkFactorsPerLevel(self.shrinkFactors)
+		method.SetSmoothingSigmasPerLevel(self.smoothingSigmas)
+		method.SmoothingSigmasAreSpecifiedInPhysicalUnitsOn()
+		if self.numberOfThreads > 0:
+			method.SetNumberOfThreads(self.numberOfThreads)
+		return method
+
+	@staticmethod
+	def volumeToImage( volumeNode ):
+
+		""" Wraps the voxels of a volume node in a float SimpleITK image with
+			the same geometry. ITK works in LPS rather than RAS coordinates.
+		"""
+
+		imageData = volumeNode.GetImageData()
+		dimensions = imageData.GetDimensions()
+		array = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+		array = array.reshape(dimensions[2], dimensions[1], dimensions[0], -1)[:,:,:,0]
+
+		image = sitk.GetImageFromArray(array.astype(numpy.float32))
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		volumeNode.GetIJKToRASMatrix(ijkToRas)
+		spacing = volumeNode.GetSpacing()
+		direction = []
+		for row in range(3):
+			flip = -1 if row < 2 else 1
+			direction += [flip * ijkToRas.GetElement(row, column) / spacing[column] for column in range(3)]
+
+		image.SetSpacing(spacing)
+		image.SetOrigin([-ijkToRas.GetElement(0, 3), -ijkToRas.GetElement(1, 3), ijkToRas.GetElement(2, 3)])
+		image.SetDirection(direction)
+		return image
+
+	@staticmethod
+	def transformToMatrix( transform ):
+
+		""" Returns the RAS vtkMatrix4x4 of a linear SimpleITK transform, in the
+			resampling (fixed to moving) direction, i.e. the transform from
+			parent in Slicer's terms.
+		"""
+
+		linear = sitk.AffineTransform(3)
+		linear.SetCenter(transform.GetCenter())
+		linear.SetMatrix(transform.GetMatrix())
+		linear.SetTranslation(transform.GetTranslation())
+
+		matrix = numpy.array(linear.GetMatrix()).reshape(3, 3)
+		center = numpy.array(linear.GetCenter())
+		offset = center + numpy.array(linear.GetTranslation()) - numpy.dot(matrix, center)
+
+		lpsToRas = numpy.diag([-1.0, -1.0, 1.0])
+		matrix = numpy.dot(lpsToRas, numpy.dot(matrix, lpsToRas))
+		offset = numpy.dot(lpsToRas, offset)
+
+		fromParent = vtk.vtkMatrix4x4()
+		for row in range(3):
+			for column in range(3):
+				fromParent.SetElement(row, column, matrix[row, column])
+			fromParent.SetElement(row, 3, offset[row])
+		return fromParent
+
+	@staticmethod
+	def matrixToTransform( fromParent ):
+
+		""" The inverse of transformToMatrix: returns the SimpleITK affine
+			transform of a RAS transform-from-parent vtkMatrix4x4.
+		"""
+
+		matrix = numpy.array([[fromParent.GetElement(row, column) for column in range(3)] for row in range(3)])
+		offset = numpy.array([fromParent.GetElement(row, 3) for row in range(3)])
+
+		rasToLps = numpy.diag([-1.0, -1.0, 1.0])
+		matrix = numpy.dot(rasToLps, numpy.dot(matrix, rasToLps))
+		offset = numpy.dot(rasToLps, offset)
+
+		transform = sitk.AffineTransform(3)
+		transform.SetMatrix(matrix.ravel().tolist())
+		transform.SetTranslation(offset.tolist())
+		return transform
+
+	@staticmethod
+	def nearestRigidTransform( transform, fixedImage ):
+
+		""" Returns the rigid transform, centered on fixedImage, with the
+			rotation nearest to the linear part of transform, that agrees with
+			transform at the center.
+		"""
+
+		size = fixedImage.GetSize()
+		center = numpy.array(fixedImage.TransformContinuousIndexToPhysicalPoint([(size[axis] - 1) / 2.0 for axis in range(3)]))
+
+		matrix = numpy.array(transform.GetMatrix()).reshape(3, 3)
+		u, s, vt = numpy.linalg.svd(matrix)
+		if numpy.linalg.det(numpy.dot(u, vt)) < 0:
+			u[:,2] = -u[:,2]
+		rotation = numpy.dot(u, vt)
+
+		rigid = sitk.Euler3DTransform()
+		rigid.SetCenter(center.tolist())
+		rigid.SetMatrix(rotation.ravel().tolist())
+		rigid.SetTranslation((numpy.array(transform.TransformPoint(center.tolist())) - center).tolist())
+		return rigid
+
+	@staticmethod
+	def resampleToVolume( movingVolume, movingImage, fixedVolume, fixedImage, transform, outputVolume ):
+
+		""" Resamples the moving image onto the lattice of the fixed volume and
+			stores it in outputVolume, with the moving volume's scalar type.
+		"""
+
+		resampled = sitk.Resample(movingImage, fixedImage, transform, sitk.sitkLinear, 0.0)
+
+		movingScalars = movingVolume.GetImageData().GetPointData().GetScalars()
+		scalarType = numpy_support.get_numpy_array_type(movingScalars.GetDataType())
+		array = sitk.GetArrayFromImage(resampled)
+		if numpy.issubdtype(scalarType, numpy.integer):
+			array = numpy.round(array)
+		array = array.astype(scalarType)
+
+		outputImage = vtk.vtkImageData()
+		outputImage.SetDimensions(fixedVolume.GetImageData().GetDimensions())
+		outputImage.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array.ravel(), deep=1, array_type=movingScalars.GetDataType()))
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		fixedVolume.GetIJKToRASMatrix(ijkToRas)
+		outputVolume.SetIJKToRASMatrix(ijkToRas)
+		outputVolume.SetAndObserveImageData(outputImage)
+
+		if outputVolume.GetDisplayNode() == None:
+			outputVolume.CreateDefaultDisplayNodes()
+
+class RegistrationJob( object ):
+
+	""" Runs one registration, with BRAINSFit or in-process, and follows it
+		until it stops. While it runs, progressCallback(status, progress) is
+		called with the status string and the percentage done. When it stops,
+		the observer on the CLI node is removed and completionCallback(status)
+		is called once, with 'Completed', 'Cancelled' or the failure status.
+		numberOfThreads limits the cores used, -1 uses all of them.
+	"""
+
+	def __init__( self, progressCallback, completionCallback, numberOfThreads=-1 ):
+
+		self.progressCallback = progressCallback
+		self.completionCallback = completionCallback
+		self.numberOfThreads = numberOfThreads
+
+		# Set once the job has started, for reporting.
+		self.engine = None
+		self.elapsedTime = None
+
+		self.__cliNode = None
+		self.__cliObserverTag = None
+		self.__inProcessRegistration = None
+		self.__startTime = None
+		self.__lastEventTime = 0
+
+	def start( self, parameters, inProcess=False, wait_for_completion=False ):
+
+		""" Starts registering with the BRAINSFit parameters given. An
+			in-process registration returns once it has stopped, as does a
+			BRAINSFit one if wait_for_completion is set.
+		"""
+
+		self.__startTime = time.time()
+
+		if inProcess:
+			self.engine = 'in-process'
+			self.__inProcessRegistration = InProcessRegistration()
+			self.__inProcessRegistration.numberOfThreads = self.numberOfThreads
+			self.__inProcessRegistration.progressCallback = self.__onInProcessProgress
+			try:
+				completed = self.__inProcessRegistration.run(parameters) != None
+			finally:
+				self.__inProcessRegistration = None
+			self.__finish('Completed' if completed else 'Cancelled')
+			return
+
+		self.engine = 'BRAINSFit'
+		parameters = dict(parameters)
+		parameters['numberOfThreads'] = self.numberOfThreads
+		self.__cliNode = slicer.cli.run(slicer.modules.brainsfit, None, parameters, wait_for_completion=wait_for_completion)
+		self.__cliObserverTag = self.__cliNode.AddObserver('ModifiedEvent', self.__onCLIModified)
+
+		# A blocking run has already finished, so no more events will come.
+		if wait_for_completion:
+			self.__onCLIModified(self.__cliNode, None)
+
+	def cancel( self ):
+
+		if self.__cliNode != None:
+			self.__cliNode.Cancel()
+		elif self.__inProcessRegistration != None:
+			self.__inProcessRegistration.cancel()
+
+	def isRunning( self ):
+
+		return self.__cliNode != None or self.__inProcessRegistration != None
+
+	def __onCLIModified( self, node, event ):
+
+		if node.IsBusy():
+			self.progressCallback(node.GetStatusString(), node.GetProgress())
+			return
+
+		node.RemoveObserver(self.__cliObserverTag)
+		self.__cliObserverTag = None
+		self.__cliNode = None
+		self.__finish(node.GetStatusString())
+
+	def __onInProcessProgress( self, progress ):
+
+		# Called from the optimizer on the main thread, so events are processed
+		# here for the progress to show and for a cancel click to be seen. A
+		# few times a second is enough.
+		if time.time() - self.__lastEventTime < 0.1:
+			return
+		self.__lastEventTime = time.time()
+		self.progressCallback('Running', progress)
+		slicer.app.processEvents()
+
+	def __finish( self, status ):
+
+		self.elapsedTime = time.time() - self.__startTime
+		self.completionCallback(status)
+
+class RegistrationCache( object ):
+
+	""" Remembers registration results, so that running a registration again
+		with the same volumes and settings restores the earlier result
+		instead of recomputing it. Entries are keyed by a hash of the voxels
+		and geometry of the fixed and moving volumes (and of their masks,
+		if any), the transformType, samplingPercentage and
+		initializeTransformMode parameters, and the engine that was used. The registered volume, and the matrix of a
+		linear transform, are kept in memory for the most recent entries,
+		and in a directory so that they outlive the Slicer session. BSpline
+		transforms are not kept, so BSpline registrations should not be
+		stored.
+	"""
+
+	def __init__( self, directory, maximumEntries=10, maximumMemoryEntries=2 ):
+
+		self.directory = directory
+		self.maximumEntries = maximumEntries
+		self.maximumMemoryEntries = maximumMemoryEntries
+
+		self.__memoryEntries = collections.OrderedDict()
+
+		# Hashing a volume means reading all of it, so it is only done again
+		# when the image has been modified.
+		self.__fingerprints = {}
+
+	def getKey( self, parameters, engine ):
+
+		fields = [self.getFingerprint(parameters['fixedVolume']), self.getFingerprint(parameters['movingVolume']),
+				  str(parameters['transformType']), repr(float(parameters['samplingPercentage'])),
+				  str(parameters['initializeTransformMode']), engine]
+		for maskKey in ['fixedBinaryVolume', 'movingBinaryVolume']:
+			if parameters.get('maskProcessingMode') == 'ROI' and parameters.get(maskKey) != None:
+				fields.append(maskKey + ' ' + self.getFingerprint(parameters[maskKey]))
+		if parameters.get('initialTransform') != None:
+			initialMatrix = vtk.vtkMatrix4x4()
+			parameters['initialTransform'].GetMatrixTransformFromParent(initialMatrix)
+			fields.append(repr([initialMatrix.GetElement(row, column) for row in range(4) for column in range(4)]))
+		return hashlib.sha1('\n'.join(fields).encode('utf-8')).hexdigest()
+
+	def getFingerprint( self, volumeNode ):
+
+		imageData = volumeNode.GetImageData()
+		memoKey = (volumeNode.GetID(), imageData.GetMTime(), volumeNode.GetMTime())
+		if memoKey in self.__fingerprints:
+			return self.__fingerprints[memoKey]
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		volumeNode.GetIJKToRASMatrix(ijkToRas)
+		array = numpy.ascontiguousarray(numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()))
+
+		fingerprint = hashlib.sha1()
+		fingerprint.update(repr([imageData.GetDimensions(), str(array.dtype), [ijkToRas.GetElement(row, column) for row in range(4) for column in range(4)]]).encode('utf-8'))
+		fingerprint.update(array.data)
+
+		if len(self.__fingerprints) > 16:
+			self.__fingerprints.clear()
+		self.__fingerprints[memoKey] = fingerprint.hexdigest()
+		return self.__fingerprints[memoKey]
+
+	def store( self, key, parameters ):
+
+		""" Records the output volume, and the matrix of linearTransform if
+			there is one, under key.
+		"""
+
+		outputVolume = parameters['outputVolume']
+		ijkToRas = vtk.vtkMatrix4x4()
+		outputVolume.GetIJKToRASMatrix(ijkToRas)
+
+		entry = {}
+		entry['dimensions'] = list(outputVolume.GetImageData().GetDimensions())
+		entry['ijkToRas'] = [ijkToRas.GetElement(row, column) for row in range(4) for column in range(4)]
+		entry['scalarType'] = outputVolume.GetImageData().GetScalarType()
+		entry['transform'] = None
+		if parameters.get('linearTransform') != None:
+			fromParent = vtk.vtkMatrix4x4()
+			parameters['linearTransform'].GetMatrixTransformFromParent(fromParent)
+			entry['transform'] = [fromParent.GetElement(row, column) for row in range(4) for column in range(4)]
+		array = numpy.array(numpy_support.vtk_to_numpy(outputVolume.GetImageData().GetPointData().GetScalars()))
+
+		self.__remember(key, [entry, array])
+
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			numpy.save(os.path.join(self.directory, key + '.npy'), array)
+			with open(os.path.join(self.directory, key + '.json'), 'w') as entryFile:
+				json.dump(entry, entryFile)
+			self.__prune()
+		except (IOError, OSError) as e:
+			Helper.Error('Could not write to the registration cache: ' + str(e))
+
+	def restore( self, key, parameters ):
+
+		""" Writes the result stored under key into the output volume, and
+			linearTransform if given. Returns False if there is none.
+		"""
+
+		if key in self.__memoryEntries:
+			entry, array = self.__memoryEntries[key]
+			self.__remember(key, [entry, array])
+		else:
+			entryPath = os.path.join(self.directory, key + '.json')
+			if not os.path.isfile(entryPath):
+				return False
+			try:
+				with open(entryPath) as entryFile:
+					entry = json.load(entryFile)
+				array = numpy.load(os.path.join(self.directory, key + '.npy'))
+			except (IOError, OSError, ValueError) as e:
+				Helper.Error('Could not read from the registration cache: ' + str(e))
+				return False
+			self.__remember(key, [entry, array])
+
+		outputImage = vtk.vtkImageData()
+		outputImage.SetDimensions(entry['dimensions'])
+		outputImage.GetPointData().SetScalars(numpy_support.numpy_to_vtk(array, deep=1, array_type=entry['scalarType']))
+
+		outputVolume = parameters['outputVolume']
+		outputVolume.SetIJKToRASMatrix(self.listToMatrix(entry['ijkToRas']))
+		outputVolume.SetAndObserveImageData(outputImage)
+		if outputVolume.GetDisplayNode() == None:
+			outputVolume.CreateDefaultDisplayNodes()
+
+		if parameters.get('linearTransform') != None and entry['transform'] != None:
+			parameters['linearTransform'].SetMatrixTransformFromParent(self.listToMatrix(entry['transform']))
+
+		return True
+
+	@staticmethod
+	def listToMatrix( elements ):
+
+		matrix = vtk.vtkMatrix4x4()
+		for row in range(4):
+			for column in range(4):
+				matrix.SetElement(row, column, elements[4*row + column])
+		return matrix
+
+	def __remember( self, key, entry ):
+
+		self.__memoryEntries.pop(key, None)
+		self.__memoryEntries[key] = entry
+		while len(self.__memoryEntries) > self.maximumMemoryEntries:
+			self.__memoryEntries.popitem(last=False)
+
+	def __prune( self ):
+
+		# Keeps the most recently written entries on disk.
+		entries = [name[:-len('.json')] for name in os.listdir(self.directory) if name.endswith('.json')]
+		entries.sort(key=lambda name: os.path.getmtime(os.path.join(self.directory, name + '.json')))
+		for name in entries[:max(0, len(entries) - self.maximumEntries)]:
+			for extension in ['.json', '.npy']:
+				path = os.path.join(self.directory, name + extension)
+				if os.path.isfile(path):
+					os.remove(path)
+
+class RegionRegistration( object ):
+
+	""" Prepares a deformable registration of a region of two volumes, rather
+		than of the whole scans, to bring the memory BRAINSFit needs down
+		towards memoryTarget MB. The fixed volume is cropped to the region, and
+		the moving volume to the part of it that covers the region, with
+		movingPadding mm of room for misalignment. If the crops would still be
+		estimated to need more than memoryTarget, both are resampled more
+		coarsely. It is a target for that estimate, not a bound: BRAINSFit is
+		not limited, and may use more. The transform found is in physical
+		coordinates, so finish() applies it to the whole moving volume, on the
+		full fixed grid, with BRAINSResample. The BSpline grid only covers the
+		crop, and its displacement is zero outside it, so there only the
+		initial transform, if any, applies and the result may be
+		discontinuous at the border of the crop.
+	"""
+
+	# A rough figure for BRAINSFit's peak memory in a BSpline registration, in
+	# bytes per voxel of the two cropped volumes together. It covers float
+	# copies of the images and their pyramids, and the image gradients.
+	bytesPerVoxel = 48
+
+	def __init__( self, memoryTarget=4096, movingPadding=20.0 ):
+
+		self.memoryTarget = memoryTarget
+		self.movingPadding = movingPadding
+
+		# Filled in by prepare() and finish(), for reporting. peakMemory is the
+		# resident size of BRAINSFit at its peak, in MB. The platform only keeps
+		# a high-water mark over all child processes, so it is None when
+		# unknown: when the mark did not move while BRAINSFit ran, because an
+		# earlier child used more, or when the platform does not report it.
+		self.regionDimensions = None
+		self.downsamplingFactor = None
+		self.estimatedMemory = None
+		self.peakMemory = None
+
+		self.__memoryBefore = None
+		self.__parameters = None
+		self.__temporaryNodes = []
+
+	def prepare( self, parameters, extent ):
+
+		""" Returns a copy of the BRAINSFit parameters that registers only the
+			extent of the fixed volume given, in its IJK coordinates. The
+			original parameters are kept for finish().
+		"""
+
+		self.__parameters = parameters
+
+		fixedVolume = parameters['fixedVolume']
+		movingVolume = parameters['movingVolume']
+		movingExtent = self.getCoveringExtent(fixedVolume, extent, movingVolume, parameters.get('initialTransform'))
+
+		voxels = float(self.countVoxels(extent) + self.countVoxels(movingExtent))
+		self.downsamplingFactor = max(1.0, (voxels * self.bytesPerVoxel / (self.memoryTarget * 1024.0 * 1024)) ** (1.0 / 3))
+
+		regionParameters = dict(parameters)
+
+		# The moving crop was chosen assuming the volumes already line up, so
+		# without an initial transform they are registered from where they are.
+		# Centers or moments of the two crops need not correspond.
+		if parameters.get('initialTransform') == None:
+			regionParameters['initializeTransformMode'] = 'Off'
+
+		regionParameters['fixedVolume'] = self.cropVolume(fixedVolume, extent, self.downsamplingFactor, False)
+		regionParameters['movingVolume'] = self.cropVolume(movingVolume, movingExtent, self.downsamplingFactor, False)
+		if parameters.get('fixedBinaryVolume') != None:
+			regionParameters['fixedBinaryVolume'] = self.cropVolume(parameters['fixedBinaryVolume'], extent, self.downsamplingFactor, True)
+		if parameters.get('movingBinaryVolume') != None:
+			regionParameters['movingBinaryVolume'] = self.cropVolume(parameters['movingBinaryVolume'], movingExtent, self.downsamplingFactor, True)
+
+		regionParameters['outputVolume'] = slicer.vtkMRMLScalarVolumeNode()
+		regionParameters['outputVolume'].SetName(slicer.mrmlScene.GetUniqueNameByString('RegionRegistration'))
+		slicer.mrmlScene.AddNode(regionParameters['outputVolume'])
+		self.__temporaryNodes.append(regionParameters['outputVolume'])
+
+		# Read just before BRAINSFit starts; nothing here runs a child process.
+		self.__memoryBefore = self.getChildPeakMemory()
+
+		croppedVoxels = self.countVoxels(regionParameters['fixedVolume'].GetImageData().GetExtent()) + self.countVoxels(regionParameters['movingVolume'].GetImageData().GetExtent())
+		self.regionDimensions = regionParameters['fixedVolume'].GetImageData().GetDimensions()
+		self.estimatedMemory = croppedVoxels * self.bytesPerVoxel / (1024.0 * 1024)
+
+		return regionParameters
+
+	def finish( self, completed ):
+
+		""" If the registration completed, resamples the whole moving volume
+			into the original outputVolume with the transform found. The
+			cropped volumes are removed either way.
+		"""
+
+		# Read before BRAINSResample runs, so that only BRAINSFit is measured.
+		memoryAfter = self.getChildPeakMemory()
+		self.peakMemory = None
+		if completed and self.__memoryBefore != None and memoryAfter != None and memoryAfter > self.__memoryBefore:
+			self.peakMemory = memoryAfter
+
+		if completed:
+			parameters = self.__parameters
+			resampleParameters = {}
+			resampleParameters['inputVolume'] = parameters['movingVolume']
+			resampleParameters['referenceVolume'] = parameters['fixedVolume']
+			resampleParameters['outputVolume'] = parameters['outputVolume']
+			resampleParameters['warpTransform'] = parameters['bsplineTransform']
+			resampleParameters['interpolationMode'] = parameters.get('interpolationMode', 'Linear')
+			slicer.cli.run(slicer.modules.brainsresample, None, resampleParameters, wait_for_completion=True)
+
+		for node in self.__temporaryNodes:
+			slicer.mrmlScene.RemoveNode(node)
+		self.__temporaryNodes = []
+
+	def getCoveringExtent( self, fixedVolume, extent, movingVolume, initialTransform=None ):
+
+		""" Returns the extent of the moving volume that covers the given extent
+			of the fixed volume, once mapped through initialTransform if given,
+			grown by movingPadding.
+		"""
+
+		fixedIjkToRas = vtk.vtkMatrix4x4()
+		fixedVolume.GetIJKToRASMatrix(fixedIjkToRas)
+
+		fixedToMoving = vtk.vtkMatrix4x4()
+		if initialTransform != None:
+			initialTransform.GetMatrixTransformFromParent(fixedToMoving)
+
+		movingRasToIjk = vtk.vtkMatrix4x4()
+		movingVolume.GetRASToIJKMatrix(movingRasToIjk)
+
+		corners = []
+		for i in extent[0:2]:
+			for j in extent[2:4]:
+				for k in extent[4:6]:
+					corners.append(movingRasToIjk.MultiplyPoint(fixedToMoving.MultiplyPoint(fixedIjkToRas.MultiplyPoint([i, j, k, 1])))[:3])
+
+		spacing = movingVolume.GetSpacing()
+		wholeExtent = movingVolume.GetImageData().GetExtent()
+		movingExtent = []
+		for axis in range(3):
+			padding = self.movingPadding / spacing[axis]
+			lower = int(math.floor(min([corner[axis] for corner in corners]) - padding))
+			upper = int(math.ceil(max([corner[axis] for corner in corners]) + padding))
+			movingExtent += [min(max(lower, wholeExtent[2*axis]), wholeExtent[2*axis+1]), max(min(upper, wholeExtent[2*axis+1]), wholeExtent[2*axis])]
+		return movingExtent
+
+	@staticmethod
+	def countVoxels( extent ):
+
+		return (extent[1] - extent[0] + 1) * (extent[3] - extent[2] + 1) * (extent[5] - extent[4] + 1)
+
+	def cropVolume( self, volumeNode, extent, factor, nearest ):
+
+		""" Adds a temporary volume node holding the extent of volumeNode,
+			sampled every factor voxels, with the matching geometry.
+		"""
+
+		dimensions = [int(math.floor((extent[2*axis+1] - extent[2*axis]) / factor)) + 1 for axis in range(3)]
+
+		reslice = vtk.vtkImageReslice()
+		reslice.SetInputData(volumeNode.GetImageData())
+		reslice.SetOutputOrigin(extent[0], extent[2], extent[4])
+		reslice.SetOutputSpacing(factor, factor, factor)
+		reslice.SetOutputExtent(0, dimensions[0]-1, 0, dimensions[1]-1, 0, dimensions[2]-1)
+		if nearest:
+			reslice.SetInterpolationModeToNearestNeighbor()
+		else:
+			reslice.SetInterpolationModeToLinear()
+		reslice.Update()
+
+		croppedImage = vtk.vtkImageData()
+		croppedImage.DeepCopy(reslice.GetOutput())
+		croppedImage.SetOrigin(0, 0, 0)
+		croppedImage.SetSpacing(1, 1, 1)
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		volumeNode.GetIJKToRASMatrix(ijkToRas)
+		corner = ijkToRas.MultiplyPoint([extent[0], extent[2], extent[4], 1])
+		for row in range(3):
+			for column in range(3):
+				ijkToRas.SetElement(row, column, ijkToRas.GetElement(row, column) * factor)
+			ijkToRas.SetElement(row, 3, corner[row])
+
+		croppedVolume = slicer.vtkMRMLLabelMapVolumeNode() if volumeNode.IsA('vtkMRMLLabelMapVolumeNode') else slicer.vtkMRMLScalarVolumeNode()
+		croppedVolume.SetName(slicer.mrmlScene.GetUniqueNameByString(volumeNode.GetName() + '_region'))
+		croppedVolume.SetIJKToRASMatrix(ijkToRas)
+		croppedVolume.SetAndObserveImageData(croppedImage)
+		slicer.mrmlScene.AddNode(croppedVolume)
+		self.__temporaryNodes.append(croppedVolume)
+
+		return croppedVolume
+
+	@staticmethod
+	def getChildPeakMemory():
+
+		if resource == None:
+			return None
+		peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+		# Reported in bytes on macOS and in kilobytes elsewhere.
+		return peak / (1024.0 * 1024) if sys.platform == 'darwin' else peak / 1024.0
@@ -0,0 +1,191 @@
+""" This file holds measures of how well a registered volume matches the
+	fixed volume it was registered to. Automatic registration in Step 2
+	uses them to decide whether a more flexible transform is needed, and
+	every registration stores them on the parameter node, so that failed
+	registrations can be flagged in batch runs without looking at them.
+	They are computed with numpy straight from the image buffers, on a
+	regular subsample of the voxels, so they take milliseconds even on
+	large scans.
+"""
+
+from __main__ import vtk, slicer
+
+import math
+import numpy
+from vtk.util import numpy_support
+
+class RegistrationMetrics( object ):
+
+	def __init__( self, maximumSamples=200000, numberOfHistogramBins=32 ):
+
+		# Every step-th voxel along each axis is used, with step chosen so that
+		# no more than this many voxels are looked at.
+		self.maximumSamples = maximumSamples
+
+		# Bins along each axis of the joint histogram for mutual information.
+		self.numberOfHistogramBins = numberOfHistogramBins
+
+	@staticmethod
+	def getGeometry( volumeNode ):
+
+		""" Returns [ijkToRas, extent] of a volume, to be passed as the moving
+			geometry. Taken before registering, as the moving volume may be
+			replaced by the registered one.
+		"""
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		volumeNode.GetIJKToRASMatrix(ijkToRas)
+		return [ijkToRas, list(volumeNode.GetImageData().GetExtent())]
+
+	def getOverlapSamples( self, fixedVolume, registeredVolume, movingGeometry=None, transformNode=None ):
+
+		""" Returns [fixed, registered], the values of both volumes at the
+			sampled voxels where the registered volume overlaps the moving
+			volume it was resampled from. Registration resamples onto the
+			lattice of the fixed volume, so both volumes must share it.
+			Returns None if they do not, or if they hardly overlap.
+
+			The overlap is found by mapping the samples through transformNode
+			into movingGeometry, from getGeometry. Without them, voxels that
+			are 0 in the registered volume are taken to be outside, which also
+			drops real zero-valued voxels and biases the scores.
+		"""
+
+		fixedImage = fixedVolume.GetImageData()
+		registeredImage = registeredVolume.GetImageData()
+		if fixedImage == None or registeredImage == None:
+			return None
+
+		dimensions = fixedImage.GetDimensions()
+		if list(registeredImage.GetDimensions()) != list(dimensions):
+			return None
+
+		step = max(1, int(math.ceil((float(dimensions[0]) * dimensions[1] * dimensions[2] / self.maximumSamples) ** (1.0 / 3))))
+		fixed = self.getArray(fixedImage)[::step, ::step, ::step].astype(numpy.float64).ravel()
+		registered = self.getArray(registeredImage)[::step, ::step, ::step].astype(numpy.float64).ravel()
+
+		if movingGeometry != None:
+			overlap = self.getSupport(fixedVolume, step, movingGeometry, transformNode)
+		else:
+			# Voxels that map outside the moving volume are filled with 0.
+			overlap = registered != 0
+		if numpy.count_nonzero(overlap) < 2:
+			return None
+
+		return [fixed[overlap], registered[overlap]]
+
+	def getSupport( self, fixedVolume, step, movingGeometry, transformNode=None ):
+
+		""" Returns whether each voxel of the fixed volume sampled every step
+			voxels, in the order of getOverlapSamples, maps inside the moving
+			volume of movingGeometry through transformNode, i.e. whether its
+			registered value was interpolated from moving voxels rather than
+			filled in.
+		"""
+
+		dimensions = fixedVolume.GetImageData().GetDimensions()
+		k, j, i = numpy.mgrid[0:dimensions[2]:step, 0:dimensions[1]:step, 0:dimensions[0]:step]
+		ijk = numpy.vstack([i.ravel(), j.ravel(), k.ravel()]).astype(numpy.float64)
+
+		fixedIjkToRas = vtk.vtkMatrix4x4()
+		fixedVolume.GetIJKToRASMatrix(fixedIjkToRas)
+		fixedIjkToRas = self.matrixToArray(fixedIjkToRas)
+		ras = (numpy.dot(fixedIjkToRas[:3,:3], ijk) + fixedIjkToRas[:3,3:]).T
+
+		# Resampling maps points of the fixed volume through the transform from parent.
+		if transformNode != None:
+			points = vtk.vtkPoints()
+			points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(ras), deep=1))
+			mappedPoints = vtk.vtkPoints()
+			transformNode.GetTransformFromParent().TransformPoints(points, mappedPoints)
+			ras = numpy_support.vtk_to_numpy(mappedPoints.GetData()).astype(numpy.float64)
+
+		movingRasToIjk = numpy.linalg.inv(self.matrixToArray(movingGeometry[0]))
+		movingIjk = numpy.dot(ras, movingRasToIjk[:3,:3].T) + movingRasToIjk[:3,3]
+
+		# Interpolation accepts points up to half a voxel past the outer voxel centers.
+		extent = movingGeometry[1]
+		inside = numpy.ones(len(movingIjk), dtype=bool)
+		for axis in range(3):
+			inside &= (movingIjk[:,axis] >= extent[2*axis] - 0.5) & (movingIjk[:,axis] <= extent[2*axis+1] + 0.5)
+		return inside
+
+	@staticmethod
+	def matrixToArray( matrix ):
+
+		return numpy.array([[matrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+	@staticmethod
+	def getArray( imageData ):
+
+		dimensions = imageData.GetDimensions()
+		array = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+		return array.reshape(dimensions[2], dimensions[1], dimensions[0], -1)[:,:,:,0]
+
+	def getScores( self, fixedVolume, registeredVolume, movingGeometry=None, transformNode=None ):
+
+		""" Returns a dictionary with the normalized cross-correlation (NCC),
+			mutual information (MI) and mean absolute difference (MAD) of the
+			two volumes, all from the same samples (see getOverlapSamples).
+			Scores that cannot be computed are None.
+		"""
+
+		samples = self.getOverlapSamples(fixedVolume, registeredVolume, movingGeometry, transformNode)
+		if samples == None:
+			return {'NCC': None, 'MI': None, 'MAD': None}
+
+		return {'NCC': self.getCorrelation(samples[0], samples[1]),
+				'MI': self.getMutualInformation(samples[0], samples[1], self.numberOfHistogramBins),
+				'MAD': self.getMeanAbsoluteDifference(samples[0], samples[1])}
+
+	def normalizedCrossCorrelation( self, fixedVolume, registeredVolume, movingGeometry=None, transformNode=None ):
+
+		samples = self.getOverlapSamples(fixedVolume, registeredVolume, movingGeometry, transformNode)
+		if samples == None:
+			return None
+
+		return self.getCorrelation(samples[0], samples[1])
+
+	@staticmethod
+	def getCorrelation( fixed, registered ):
+
+		""" Pearson correlation of two arrays of voxel values, from -1 to 1,
+			where 1 is a perfect linear match. None if either is constant.
+		"""
+
+		fixed = fixed - fixed.mean()
+		registered = registered - registered.mean()
+		denominator = math.sqrt(numpy.dot(fixed, fixed) * numpy.dot(registered, registered))
+		if denominator == 0:
+			return None
+
+		return float(numpy.dot(fixed, registered) / denominator)
+
+	@staticmethod
+	def getMutualInformation( fixed, registered, numberOfBins ):
+
+		""" Mutual information, in nats, of two arrays of voxel values, from
+			their joint histogram over numberOfBins bins per axis. Unlike the
+			correlation, it does not assume the intensities match linearly.
+		"""
+
+		def binIndices( values ):
+			low, high = values.min(), values.max()
+			if high == low:
+				return numpy.zeros(len(values), dtype=numpy.int64)
+			return numpy.minimum(((values - low) * (numberOfBins / (high - low))).astype(numpy.int64), numberOfBins - 1)
+
+		joint = numpy.bincount(binIndices(fixed) * numberOfBins + binIndices(registered), minlength=numberOfBins * numberOfBins)
+		joint = joint.reshape(numberOfBins, numberOfBins) / float(len(fixed))
+
+		fixedMarginal = joint.sum(axis=1)
+		registeredMarginal = joint.sum(axis=0)
+		rows, columns = numpy.nonzero(joint)
+		probabilities = joint[rows, columns]
+
+		return float(numpy.sum(probabilities * numpy.log(probabilities / (fixedMarginal[rows] * registeredMarginal[columns]))))
+
+	@staticmethod
+	def getMeanAbsoluteDifference( fixed, registered ):
+
+		return float(numpy.abs(fixed - registered).mean())
@@ -153,6 +153,8 @@ class ReviewStep( SegmentationWizardStep ) :
 
 		if self.__RemoveRegisteredImage.checked:
 			slicer.mrmlScene.RemoveNode(Helper.getNodeByID(pNode.GetParameter('registrationVolumeID')))
+			slicer.mrmlScene.RemoveNode(Helper.getNodeByID(pNode.GetParameter('registrationMaskID')))
+			slicer.mrmlScene.RemoveNode(Helper.getNodeByID(pNode.GetParameter('registrationMovingMaskID')))
 
 		if self.__RemoveNormalizedImages.checked:
 			for node in [pNode.GetParameter('baselineNormalizeVolumeID'), pNode.GetParameter('followupNormalizeVolumeID')]:
@@ -164,9 +166,17 @@ class ReviewStep( SegmentationWizardStep ) :
 
 		if self.__RemoveCroppedMap.checked:
 			slicer.mrmlScene.RemoveNode(Helper.getNodeByID(pNode.GetParameter('croppedVolumeID')))
+			croppedVolumeList = pNode.GetParameter('croppedVolumeList')
+			if croppedVolumeList == None:
+				croppedVolumeList = ''
+			for croppedID in croppedVolumeList.split('__'):
+				if croppedID != '':
+					slicer.mrmlScene.RemoveNode(Helper.getNodeByID(croppedID))
 
 		if self.__RemoveROI.checked:
 			slicer.mrmlScene.RemoveNode(Helper.getNodeByID(pNode.GetParameter('nonThresholdedLabelID')))
+			if pNode.GetParameter('roiComponentsLabelID') != '':
+				slicer.mrmlScene.RemoveNode(Helper.getNodeByID(pNode.GetParameter('roiComponentsLabelID')))
 
 		if self.__RemoveThresholdedROI.checked:
 			slicer.mrmlScene.RemoveNode(Helper.getNodeByID(pNode.GetParameter('thresholdedLabelID')))
@@ -183,6 +193,12 @@ class ReviewStep( SegmentationWizardStep ) :
 		pNode.SetParameter('originalFollowupVolumeID', '')
 
 		pNode.SetParameter('registrationVolumeID', '')
+		pNode.SetParameter('registrationMaskID', '')
+		pNode.SetParameter('registrationMovingMaskID', '')
+		pNode.SetParameter('registrationROINodeID', '')
+		pNode.SetParameter('registrationNCC', '')
+		pNode.SetParameter('registrationMI', '')
+		pNode.SetParameter('registrationMAD', '')
 
 		pNode.SetParameter('baselineNormalizeVolumeID', '')
 		pNode.SetParameter('followupNormalizeVolumeID', '')
@@ -196,7 +212,10 @@ class ReviewStep( SegmentationWizardStep ) :
 
 		pNode.SetParameter('thresholdedLabelID', '')
 		pNode.SetParameter('croppedVolumeID', '')
+		pNode.SetParameter('croppedVolumeList', '')
+		pNode.SetParameter('clipFillValue', '')
 		pNode.SetParameter('nonThresholdedLabelID', '')
+		pNode.SetParameter('roiComponentsLabelID', '')
 
 		pNode.SetParameter('roiNodeID', '')
 		pNode.SetParameter('roiTransformID', '')
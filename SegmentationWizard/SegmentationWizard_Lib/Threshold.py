@@ -6,8 +6,12 @@ from __main__ import qt, ctk, slicer
 
 from SegmentationWizardStep import *
 from Helper import *
+from ThresholdLogic import *
+from LatestWinsScheduler import LatestWinsScheduler
+from VolumeClipWithModel import *
 
 import string
+import math
 
 """ ThresholdStep inherits from SegmentationWizardStep, with itself inherits
 	from a ctk workflow class. 
@@ -32,6 +36,16 @@ class ThresholdStep( SegmentationWizardStep ) :
 		self.__roiVolume = None
 		self.__visualizedVolume = None
 
+		self.__clipLogic = VolumeClipWithModelLogic()
+		self.__thresholdEngine = None
+		self.__thresholdLabel = None
+		self.__backThresholdLabel = None
+		self.__roiHistogram = None
+		self.__voxelVolume = 0
+
+		# Slider ticks are thresholded on a worker thread, newest range first.
+		self.__thresholdScheduler = LatestWinsScheduler(self.computeThreshold, self.publishThreshold)
+
 		self.__parent = super( ThresholdStep, self )
 
 	def createUserInterface( self ):
@@ -59,11 +73,52 @@ class ThresholdStep( SegmentationWizardStep ) :
 		self.__threshRange.decimals = 0
 		self.__threshRange.singleStep = 1
 
+		# While dragging, only the visible slices are thresholded. The full
+		# label is computed once the slider is released.
+		self.__threshRange.tracking = False
+		self.__dragRange = [0, 0]
+
+		self.__volumeReadout = qt.QLabel('')
+		self.__volumeReadout.alignment = 4
+
 		self.__thresholdGroupBoxLayout.addRow(threshLabel)
 		self.__thresholdGroupBoxLayout.addRow(self.__threshRange)
+		self.__thresholdGroupBoxLayout.addRow(self.__volumeReadout)
 		self.__layout.addRow(self.__thresholdGroupBox)
 
+		# Automatic threshold suggestions, computed from the ROI histogram.
+		self.__presetGroupBox = qt.QGroupBox()
+		self.__presetGroupBox.setTitle('Threshold Presets')
+		self.__presetGroupBoxLayout = qt.QFormLayout(self.__presetGroupBox)
+
+		self.__presetSelector = qt.QComboBox()
+		self.__presetSelector.setToolTip("Select a suggested intensity range to apply it. Suggestions are computed from the intensities inside your ROI.")
+		self.__presetGroupBoxLayout.addRow('Suggested Range:', self.__presetSelector)
+		self.__layout.addRow(self.__presetGroupBox)
+		self.__thresholdPresets = []
+
+		# Multi-class mode labels several intensity bands in one pass.
+		self.__classGroupBox = qt.QGroupBox()
+		self.__classGroupBox.setTitle('Multi-Class Labeling')
+		self.__classGroupBoxLayout = qt.QFormLayout(self.__classGroupBox)
+
+		self.__classBoundaries = qt.QLineEdit()
+		self.__classBoundaries.setToolTip("Comma-separated lower intensity of each band, e.g. \"100, 200, 400\". Each band runs up to the next one; the last runs up to the top of the selected threshold range. Bands are labeled 1, 2, 3...")
+		self.__classGroupBoxLayout.addRow('Band Lower Bounds:', self.__classBoundaries)
+
+		self.__classButton = qt.QPushButton('Label Intensity Bands')
+		self.__classGroupBoxLayout.addRow(self.__classButton)
+
+		self.__classReadout = qt.QLabel('')
+		self.__classReadout.setWordWrap(True)
+		self.__classGroupBoxLayout.addRow(self.__classReadout)
+		self.__layout.addRow(self.__classGroupBox)
+
 		self.__threshRange.connect('valuesChanged(double,double)', self.onThresholdChanged)
+		self.__threshRange.connect('minimumValueIsChanging(double)', self.onMinimumThresholdDragged)
+		self.__threshRange.connect('maximumValueIsChanging(double)', self.onMaximumThresholdDragged)
+		self.__presetSelector.connect('activated(int)', self.onThresholdPresetSelected)
+		self.__classButton.connect('clicked()', self.onClassifyRequest)
 		qt.QTimer.singleShot(0, self.killButton)
 
 	def onThresholdChanged(self):
@@ -74,22 +129,175 @@ class ThresholdStep( SegmentationWizardStep ) :
 
 		range0 = self.__threshRange.minimumValue
 		range1 = self.__threshRange.maximumValue
+		self.__dragRange = [range0, range1]
+
+		# The label is computed in the background; stale ranges are dropped.
+		if self.__thresholdEngine != None:
+			self.__thresholdScheduler.submit([range0, range1])
+
+		self.updateVolumeReadout(range0, range1)
+
+	def onMinimumThresholdDragged(self, value):
+
+		self.__dragRange[0] = value
+		self.previewThreshold()
+
+	def onMaximumThresholdDragged(self, value):
+
+		self.__dragRange[1] = value
+		self.previewThreshold()
+
+	def previewThreshold(self):
+
+		""" Called while the slider is still moving. Thresholds only the slices
+			shown in the Red, Yellow and Green views, which is far less work than
+			the whole ROI. onThresholdChanged does the full label on release.
+		"""
+
+		if self.__thresholdEngine == None:
+			return
+
+		slices = self.visibleSlices()
+		if slices != []:
+			self.__thresholdEngine.previewSlices(self.__thresholdLabel, self.__dragRange[0], self.__dragRange[1], slices)
+
+		self.updateVolumeReadout(self.__dragRange[0], self.__dragRange[1])
+
+	def visibleSlices(self):
+
+		""" Returns [axis, index] for each slice view whose plane is a single
+			I, J or K slice of the thresholded label. Oblique views are skipped;
+			they show the full label once the slider is released.
+		"""
+
+		slices = []
+		layoutManager = slicer.app.layoutManager()
+		if layoutManager == None:
+			return slices
+
+		rasToIjk = vtk.vtkMatrix4x4()
+		self.__thresholdedLabelNode.GetRASToIJKMatrix(rasToIjk)
+		dimensions = self.__thresholdLabel.imageData.GetDimensions()
+
+		for sliceViewName in ['Red', 'Yellow', 'Green']:
+			sliceWidget = layoutManager.sliceWidget(sliceViewName)
+			if sliceWidget == None or not sliceWidget.isVisible():
+				continue
+
+			sliceToRas = sliceWidget.mrmlSliceNode().GetSliceToRAS()
+			normal = rasToIjk.MultiplyPoint([sliceToRas.GetElement(row, 2) for row in range(3)] + [0])
+			center = rasToIjk.MultiplyPoint([sliceToRas.GetElement(row, 3) for row in range(3)] + [1])
+
+			length = math.sqrt(normal[0]**2 + normal[1]**2 + normal[2]**2)
+			axis = max(range(3), key=lambda x: abs(normal[x]))
+			if length == 0 or abs(normal[axis]) < 0.99 * length:
+				continue
+
+			index = int(round(center[axis]))
+			if index >= 0 and index < dimensions[axis] and [axis, index] not in slices:
+				slices.append([axis, index])
+
+		return slices
+
+	def updateVolumeReadout(self, range0, range1):
+
+		# Read from the cumulative histogram, so it keeps up with the slider.
+		if self.__roiHistogram == None:
+			self.__volumeReadout.setText('')
+			return
+
+		voxelCount = self.__roiHistogram.count(range0, range1)
+		self.__volumeReadout.setText('Segmented volume: %d voxels, %.2f mL' % (voxelCount, voxelCount * self.__voxelVolume))
+
+	def computeThreshold(self, thresholdRange):
 
-		# Use vtk to threshold the label volume.
-		if self.__roiVolume != None:
-			thresh = vtk.vtkImageThreshold()
-			if vtk.VTK_MAJOR_VERSION <= 5:
-				thresh.SetInput(self.__roiVolume.GetImageData())
-			else:
-				thresh.SetInputData(self.__roiVolume.GetImageData())
-			thresh.ThresholdBetween(range0, range1)
-			thresh.SetInValue(1)
-			thresh.SetOutValue(0)
-			thresh.ReplaceOutOn()
-			thresh.ReplaceInOn()
-			thresh.Update()
-
-			self.__thresholdedLabelNode.SetAndObserveImageData(thresh.GetOutput())
+		""" Writes the range into the label that is not displayed, so the view
+			never shows a half-updated label, and rewrites only the voxels that
+			changed since that label's last range.
+		"""
+
+		self.__thresholdEngine.update(self.__backThresholdLabel, thresholdRange[0], thresholdRange[1], notify=False)
+		return self.__backThresholdLabel
+
+	def publishThreshold(self, label):
+
+		# Runs on the Qt thread. Swaps the freshly computed label onto display.
+		self.__backThresholdLabel = self.__thresholdLabel
+		self.__thresholdLabel = label
+		label.markModified()
+		self.__thresholdedLabelNode.SetAndObserveImageData(label.imageData)
+
+	def updateThresholdPresets(self):
+
+		""" Fills the preset box with Otsu, three-class Otsu and percentile
+			suggestions. All come from the histogram cached in onEntry, so no
+			thresholding is done until one is picked.
+		"""
+
+		self.__thresholdPresets = []
+		self.__classReadout.setText('')
+		self.__presetSelector.clear()
+		self.__presetSelector.addItem('Choose a preset...')
+
+		if self.__roiHistogram == None or self.__thresholdEngine.numberOfVoxels() == 0:
+			return
+
+		top = self.__threshRange.maximum
+
+		otsu = self.__roiHistogram.otsuThresholds(2)
+		multiOtsu = self.__roiHistogram.otsuThresholds(3)
+
+		self.__thresholdPresets.append(['Otsu', [otsu[0], top]])
+		self.__thresholdPresets.append(['Three-class Otsu, upper class', [multiOtsu[1], top]])
+		self.__thresholdPresets.append(['Three-class Otsu, middle class', [multiOtsu[0], multiOtsu[1] - 1]])
+		for percent in [75, 90, 95]:
+			self.__thresholdPresets.append(['Above %dth percentile' % percent, [self.__roiHistogram.percentile(percent), top]])
+
+		for name, presetRange in self.__thresholdPresets:
+			self.__presetSelector.addItem('%s (%d to %d)' % (name, math.ceil(presetRange[0]), math.floor(presetRange[1])))
+
+		# Three-class Otsu also makes a sensible starting point for intensity bands.
+		self.__classBoundaries.setText('%d, %d, %d' % (math.ceil(self.__threshRange.minimum), math.ceil(multiOtsu[0]), math.ceil(multiOtsu[1])))
+
+	def onThresholdPresetSelected(self, index):
+
+		if index < 1 or index > len(self.__thresholdPresets):
+			return
+
+		presetRange = self.__thresholdPresets[index - 1][1]
+		self.__threshRange.setValues(math.ceil(presetRange[0]), math.floor(presetRange[1]))
+		self.__presetSelector.setCurrentIndex(0)
+
+	def onClassifyRequest(self):
+
+		""" Writes one label map in which each intensity band has its own label
+			value, replacing the binary threshold label. Moving the slider again
+			goes back to a binary label.
+		"""
+
+		if self.__thresholdEngine == None:
+			return
+
+		try:
+			boundaries = sorted([float(x) for x in self.__classBoundaries.text.split(',') if x.strip() != ''])
+		except ValueError:
+			self.__classReadout.setText('Band bounds must be comma-separated numbers.')
+			return
+
+		if boundaries == []:
+			self.__classReadout.setText('Enter at least one band.')
+			return
+
+		# Waits for any pending slider update, so it does not overwrite the bands.
+		self.__thresholdScheduler.finish()
+
+		counts = self.__thresholdEngine.classify(self.__backThresholdLabel, boundaries, self.__threshRange.maximumValue, notify=False)
+		self.publishThreshold(self.__backThresholdLabel)
+
+		readout = []
+		for index, count in enumerate(counts):
+			readout.append('Label %d: %d voxels, %.2f mL' % (index + 1, count, count * self.__voxelVolume))
+		self.__classReadout.setText('\n'.join(readout))
 
 	def killButton(self):
 		# ctk creates a useless final page button. This method gets rid of it.
@@ -117,6 +325,11 @@ class ThresholdStep( SegmentationWizardStep ) :
 		# being viewed.
 
 		self.__vrDisplayNode = Helper.getNodeByID(pNode.GetParameter('vrDisplayNodeID'))
+
+		# The ROI may have changed since the last visit, so the old sort is stale.
+		self.__thresholdScheduler.cancel()
+		self.__thresholdEngine = None
+		self.__roiHistogram = None
 		self.updateWidgetFromParameters(pNode)
 
 		# Retrieves necessary nodes.
@@ -129,24 +342,35 @@ class ThresholdStep( SegmentationWizardStep ) :
 		# Adds segementation label volume.
 		Helper.SetLabelVolume(self.__thresholdedLabelNode.GetID())
 
-		threshRange = [self.__threshRange.minimumValue, self.__threshRange.maximumValue]
-
-		# Segments the entire vtk model. I assume there's a more concise way
-		# to do it than thresholding over its entire intensity range, so TODO
-		range0 = self.__threshRange.minimum
-		range1 = self.__threshRange.maximum
-		thresh = vtk.vtkImageThreshold()
-		if vtk.VTK_MAJOR_VERSION <= 5:
-			thresh.SetInput(self.__roiVolume.GetImageData())
+		# Sorts the ROI intensities once, so that later slider ticks only
+		# have to relabel the voxels that cross the threshold. Only the ROI's
+		# bounding extent is considered, and the labels are made that size.
+		fillValue = pNode.GetParameter('clipFillValue')
+		if fillValue == '':
+			fillValue = None
 		else:
-			thresh.SetInputData(self.__roiVolume.GetImageData())
-		thresh.ThresholdBetween(range0, range1)
-		thresh.SetInValue(1)
-		thresh.SetOutValue(0)
-		thresh.ReplaceOutOn()
-		thresh.ReplaceInOn()
-		thresh.Update()
-		self.__nonThresholdedLabelNode.SetAndObserveImageData(thresh.GetOutput())
+			fillValue = float(fillValue)
+		roiExtent = self.__clipLogic.getROIExtent(self.__roiVolume)
+		self.__thresholdEngine = IncrementalThresholdEngine(self.__roiVolume.GetImageData(), fillValue, roiExtent)
+
+		# Voxel counts for any threshold range come from this, without re-scanning the image.
+		self.__roiHistogram = CumulativeHistogram(self.__thresholdEngine.sortedValues())
+		spacing = self.__roiVolume.GetSpacing()
+		self.__voxelVolume = spacing[0] * spacing[1] * spacing[2] / 1000.0
+
+		self.updateThresholdPresets()
+
+		for labelNode in [self.__nonThresholdedLabelNode, self.__thresholdedLabelNode]:
+			self.__clipLogic.setExtentGeometry(labelNode, self.__roiVolume, roiExtent)
+
+		# Segments the entire ROI, i.e. everything over the slider's full range.
+		roiLabel = self.__thresholdEngine.createLabel()
+		self.__thresholdEngine.update(roiLabel, self.__threshRange.minimum, self.__threshRange.maximum)
+		self.__nonThresholdedLabelNode.SetAndObserveImageData(roiLabel.imageData)
+
+		self.__thresholdLabel = self.__thresholdEngine.createLabel()
+		self.__backThresholdLabel = self.__thresholdEngine.createLabel()
+		self.__thresholdedLabelNode.SetAndObserveImageData(self.__thresholdLabel.imageData)
 
 		# Adjusts threshold information.
 		self.onThresholdChanged()
@@ -181,6 +405,10 @@ class ThresholdStep( SegmentationWizardStep ) :
 		self.__thresholdedLabelNode = Helper.getNodeByID(labelID)
 
 	def onExit(self, goingTo, transitionType):   
+
+		# Makes sure the label reflects the final slider position.
+		self.__thresholdScheduler.finish()
+
 		pNode = self.parameterNode()
 		if self.__vrDisplayNode != None:
 			# self.__vrDisplayNode.VisibilityOff()
@@ -192,6 +420,13 @@ class ThresholdStep( SegmentationWizardStep ) :
 		pNode.SetParameter('vrThreshRangeMin', str(roiRange.minimumValue))
 		pNode.SetParameter('vrThreshRangeMax', str(roiRange.maximumValue))
 
+		# The Editor in the review step needs labels the size of the volume.
+		if goingTo.id() == 'ReviewStep' and self.__thresholdEngine != None:
+			# A cropped ROI volume does not cover the whole volume, so pad to the volume it was cropped from.
+			templateVolume, labelExtent = self.__clipLogic.getUncroppedExtent(self.__roiVolume, self.__thresholdEngine.extent())
+			for labelNode in [self.__nonThresholdedLabelNode, self.__thresholdedLabelNode]:
+				self.__clipLogic.padLabelToVolume(labelNode, templateVolume, labelExtent)
+
 		super(SegmentationWizardStep, self).onExit(goingTo, transitionType) 
 
 	def InitVRDisplayNode(self):
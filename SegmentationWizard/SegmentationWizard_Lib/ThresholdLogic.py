@@ -0,0 +1,348 @@
+""" This file does the thresholding for Step 5. The voxel values inside the
+	ROI are sorted once, so that an intensity range is a contiguous run of
+	them, and moving a slider end only flips the voxels it passes over.
+	Labels only cover the bounding extent of the ROI.
+"""
+
+from __main__ import vtk, slicer
+
+from Helper import *
+from VolumeClipWithModel import *
+
+import numpy
+from vtk.util import numpy_support
+
+class ThresholdLabel( object ):
+
+	""" A label image together with the run of sorted positions that is
+		currently set to the in-value. One engine can keep several of these
+		up to date, each remembering its own last range.
+	"""
+
+	def __init__( self, imageData, array ):
+
+		self.imageData = imageData
+		self.array = array
+		self.positions = [0, 0]
+
+		# Slices written by a preview, which do not match positions.
+		self.dirtySlices = []
+
+	def markModified( self ):
+
+		# Writing through the numpy view does not tell vtk anything changed.
+		self.imageData.GetPointData().GetScalars().Modified()
+		self.imageData.Modified()
+
+class IncrementalThresholdEngine( object ):
+
+	def __init__( self, imageData, floorValue=None, extent=None ):
+
+		""" Sorts the ROI voxels of imageData within extent. Voxels at or below
+			floorValue, which is the fill value used when clipping the ROI, are
+			left out and so are never labelled.
+		"""
+
+		if extent == None:
+			extent = imageData.GetExtent()
+		self.__extent = list(extent)
+
+		# Kept, in [k,j,i] order, for thresholding single slices during previews.
+		self.__values = numpy.array(VolumeClipWithModelLogic.getExtentArray(imageData, extent))
+		self.__floorValue = floorValue
+		values = self.__values.ravel()
+
+		if floorValue == None:
+			indices = numpy.arange(values.size)
+		else:
+			indices = numpy.flatnonzero(values > floorValue)
+
+		# 32-bit indices halve the memory of the sort order on large scans.
+		if values.size < 2**31:
+			indices = indices.astype(numpy.int32)
+
+		self.__order = indices[numpy.argsort(values[indices], kind='mergesort')]
+		self.__sortedValues = values[self.__order]
+
+	def numberOfVoxels( self ):
+
+		return self.__sortedValues.size
+
+	def sortedValues( self ):
+
+		return self.__sortedValues
+
+	def extent( self ):
+
+		return list(self.__extent)
+
+	def createLabel( self ):
+
+		""" Allocates an empty label image covering the engine's extent.
+		"""
+
+		extent = self.__extent
+		labelImage = vtk.vtkImageData()
+		labelImage.SetDimensions(extent[1]-extent[0]+1, extent[3]-extent[2]+1, extent[5]-extent[4]+1)
+		labelImage.AllocateScalars(vtk.VTK_SHORT, 1)
+
+		array = numpy_support.vtk_to_numpy(labelImage.GetPointData().GetScalars())
+		array[:] = 0
+
+		return ThresholdLabel(labelImage, array)
+
+	def update( self, label, lower, upper, notify=True ):
+
+		""" Sets label to 1 for ROI voxels with lower <= value <= upper, matching
+			vtkImageThreshold.ThresholdBetween. Only voxels whose state differs
+			from the previous call on this label are written. Returns the number
+			of voxels written. Pass notify=False when calling from a worker
+			thread, and call label.markModified() later on the Qt thread.
+		"""
+
+		start = numpy.searchsorted(self.__sortedValues, lower, side='left')
+		stop = numpy.searchsorted(self.__sortedValues, upper, side='right')
+		if stop < start:
+			stop = start
+
+		# A label last written by classify() has no single run to start from.
+		if label.positions == None:
+			label.array[:] = 0
+			label.positions = [0, 0]
+			label.dirtySlices = []
+
+		# Slices touched by a preview are first put back to the label's last range.
+		if label.dirtySlices != []:
+			oldStart, oldStop = label.positions
+			if oldStop > oldStart:
+				self.__writeSlices(label, label.dirtySlices, self.__sortedValues[oldStart], self.__sortedValues[oldStop-1])
+			else:
+				self.__writeSlices(label, label.dirtySlices, None, None)
+			label.dirtySlices = []
+
+		oldStart, oldStop = label.positions
+
+		# Any voxel that changes state lies between the old and new lower ends,
+		# or between the old and new upper ends, of the sorted run.
+		written = 0
+		for first, last in [(min(start, oldStart), max(start, oldStart)), (min(stop, oldStop), max(stop, oldStop))]:
+			if last > first:
+				positions = numpy.arange(first, last)
+				label.array[self.__order[first:last]] = (positions >= start) & (positions < stop)
+				written += last - first
+
+		label.positions = [start, stop]
+
+		if written and notify:
+			label.markModified()
+
+		return written
+
+	def classify( self, label, boundaries, upper=None, notify=True ):
+
+		""" Labels the ROI by intensity band in a single pass. Voxels from
+			boundaries[i] up to, but not including, boundaries[i+1] get the value
+			i+1. The last band runs up to upper inclusive, or to the ROI maximum.
+			boundaries must be ascending. Returns the voxel count of each band.
+		"""
+
+		sortedValues = self.__sortedValues
+
+		if upper == None:
+			stop = sortedValues.size
+		else:
+			stop = numpy.searchsorted(sortedValues, upper, side='right')
+
+		edges = numpy.searchsorted(sortedValues, boundaries, side='left')
+		edges = numpy.minimum(numpy.concatenate([edges, [stop]]), stop)
+
+		# Band of every sorted position; a lookup table written to the label at once.
+		classes = numpy.zeros(sortedValues.size, label.array.dtype)
+		for index in range(len(boundaries)):
+			classes[edges[index]:edges[index+1]] = index + 1
+
+		label.array[:] = 0
+		label.array[self.__order] = classes
+		label.positions = None
+		label.dirtySlices = []
+
+		if notify:
+			label.markModified()
+
+		return [int(count) for count in numpy.diff(edges)]
+
+	def previewSlices( self, label, lower, upper, slices ):
+
+		""" Thresholds only the given slices of label, each an [axis, index] pair
+			with axis 0, 1 or 2 for I, J or K. This is cheap enough to run on every
+			slider movement. The next call to update() on this label repairs the
+			slices before applying its range, so the rest of the label stays valid.
+		"""
+
+		self.__writeSlices(label, slices, lower, upper)
+		for sliceIndex in slices:
+			if sliceIndex not in label.dirtySlices:
+				label.dirtySlices.append(sliceIndex)
+		label.markModified()
+
+	def __writeSlices( self, label, slices, lower, upper ):
+
+		labelArray = label.array.reshape(self.__values.shape)
+
+		for axis, index in slices:
+			if axis == 0:
+				selection = (slice(None), slice(None), index)
+			elif axis == 1:
+				selection = (slice(None), index, slice(None))
+			else:
+				selection = (index, slice(None), slice(None))
+
+			if lower == None:
+				labelArray[selection] = 0
+				continue
+
+			values = self.__values[selection]
+			inside = (values >= lower) & (values <= upper)
+			if self.__floorValue != None:
+				inside &= values > self.__floorValue
+			labelArray[selection] = inside
+
+class CumulativeHistogram( object ):
+
+	""" Counts of ROI voxels below, and at or below, every integer intensity
+		between the ROI's minimum and maximum. The threshold slider moves in
+		whole numbers, so the size of any range it selects is two array lookups.
+		Non-integer ranges, and intensity spans too wide to tabulate, fall back
+		to a binary search of the sorted values.
+	"""
+
+	def __init__( self, sortedValues, maximumBins=2**22 ):
+
+		self.__sortedValues = sortedValues
+		self.__first = 0
+		self.__countBelow = None
+		self.__countAtMost = None
+		self.__binnedCounts = None
+
+		if sortedValues.size == 0:
+			return
+
+		first = int(numpy.floor(sortedValues[0]))
+		last = int(numpy.ceil(sortedValues[-1]))
+		if last - first + 1 > maximumBins:
+			return
+
+		grid = numpy.arange(first, last + 1)
+		self.__first = first
+		self.__countBelow = numpy.searchsorted(sortedValues, grid, side='left')
+		self.__countAtMost = numpy.searchsorted(sortedValues, grid, side='right')
+
+	def count( self, lower, upper ):
+
+		""" Number of ROI voxels with lower <= value <= upper.
+		"""
+
+		if upper < lower:
+			return 0
+		return self.__lookup(self.__countAtMost, upper, 'right') - self.__lookup(self.__countBelow, lower, 'left')
+
+	def binnedCounts( self, numberOfBins=256 ):
+
+		""" Returns [counts, edges] of a histogram of the ROI with numberOfBins
+			equal bins between its minimum and maximum. Computed once and cached.
+		"""
+
+		if self.__binnedCounts == None or self.__binnedCounts[0].size != numberOfBins:
+			edges = numpy.linspace(float(self.__sortedValues[0]), float(self.__sortedValues[-1]), numberOfBins + 1)
+			boundaries = numpy.searchsorted(self.__sortedValues, edges[1:-1], side='left')
+			counts = numpy.diff(numpy.concatenate([[0], boundaries, [self.__sortedValues.size]]))
+			self.__binnedCounts = [counts, edges]
+
+		return self.__binnedCounts
+
+	def percentile( self, percent ):
+
+		""" Intensity below which percent of the ROI voxels lie. The values are
+			already sorted, so this is a single lookup.
+		"""
+
+		position = int(round(percent / 100.0 * (self.__sortedValues.size - 1)))
+		return float(self.__sortedValues[position])
+
+	def otsuThresholds( self, numberOfClasses=2 ):
+
+		""" Thresholds that split the ROI histogram into numberOfClasses classes
+			with maximal between-class variance. Two and three classes are
+			supported. Each threshold is the lowest intensity of the class above it.
+		"""
+
+		if self.__sortedValues.size == 0:
+			return []
+
+		counts, edges = self.binnedCounts()
+		centers = (edges[:-1] + edges[1:]) / 2.0
+
+		# Maximizing between-class variance is the same as maximizing the sum
+		# of (class sum)^2 / (class weight) over the classes.
+		weights = numpy.cumsum(counts).astype(numpy.float64)[:-1]
+		sums = numpy.cumsum(counts * centers)[:-1]
+		totalWeight = float(counts.sum())
+		totalSum = float((counts * centers).sum())
+
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			if numberOfClasses == 2:
+				upperWeights = totalWeight - weights
+				score = sums**2 / weights + (totalSum - sums)**2 / upperWeights
+				score[(weights == 0) | (upperWeights == 0)] = -numpy.inf
+				best = self.__centerOfBest(score, counts)
+				return [float(edges[best[0] + 1])]
+
+			elif numberOfClasses == 3:
+				# Rows index the first threshold, columns the second.
+				lowWeights = weights[:,None]
+				lowSums = sums[:,None]
+				middleWeights = weights[None,:] - lowWeights
+				middleSums = sums[None,:] - lowSums
+				highWeights = totalWeight - weights[None,:]
+				highSums = totalSum - sums[None,:]
+				score = lowSums**2 / lowWeights + middleSums**2 / middleWeights + highSums**2 / highWeights
+				score[(lowWeights == 0) | (middleWeights <= 0) | (highWeights == 0)] = -numpy.inf
+				first, second = self.__centerOfBest(score, counts)
+				return [float(edges[first + 1]), float(edges[second + 1])]
+
+		raise ValueError('Otsu thresholds are only available for two or three classes.')
+
+	def __centerOfBest( self, score, counts ):
+
+		# Every threshold inside an empty stretch of histogram scores the same,
+		# so take the middle of the tied thresholds rather than the first one.
+		# Only the run around the best threshold counts, along each axis, and it
+		# ends at the next occupied bin: past it, the classes differ, even where
+		# a different split happens to score the same.
+		tied = numpy.isclose(score, score.max(), rtol=1e-12)
+		best = list(numpy.unravel_index(numpy.argmax(score), score.shape))
+
+		center = []
+		for axis in range(score.ndim):
+			line = list(best)
+			line[axis] = slice(None)
+			run = tied[tuple(line)]
+			first = last = best[axis]
+			while first > 0 and run[first - 1] and counts[first] == 0:
+				first -= 1
+			while last < run.size - 1 and run[last + 1] and counts[last + 1] == 0:
+				last += 1
+			center.append(int(round((first + last) / 2.0)))
+		return center
+
+	def __lookup( self, table, value, side ):
+
+		if table is None or value != int(value):
+			return int(numpy.searchsorted(self.__sortedValues, value, side=side))
+
+		index = int(value) - self.__first
+		if index < 0:
+			return 0
+		if index >= table.size:
+			return self.__sortedValues.size
+		return int(table[index])
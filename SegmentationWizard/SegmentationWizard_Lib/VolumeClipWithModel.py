@@ -2,6 +2,13 @@ from __main__ import qt, ctk, slicer
 from SegmentationWizardStep import *
 from Helper import *
 
+import collections
+import math
+from multiprocessing.pool import ThreadPool
+import numpy
+import time
+from vtk.util import numpy_support
+
 class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
 	"""This class should implement all the actual
 	computation done by your module.  The interface
@@ -18,101 +25,975 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
 		node.SetParameter("FillValue", "-1")
 		return node
 
-	def clipVolumeWithModel(self, inputVolume, clippingModel, clipOutsideSurface, fillValue, outputVolume):
+	def __init__(self, parent=None):
+		ScriptedLoadableModuleLogic.__init__(self, parent)
+
+		# Stencils are costly to rasterize and are reused while neither the model
+		# nor the volume lattice changes, e.g. when going back and forth between steps.
+		self.stencilCacheSize = 4
+		self.__stencilCache = collections.OrderedDict()
+
+		# Convex hull of each markup node, updated point by point as markups are edited.
+		self.__markupHulls = {}
+
+		# Whether each model currently holds the subdivided surface or the raw hull. Only
+		# set once a surface is shown, as a requested surface may never be built.
+		self.__subdividedModels = {}
+
+		# Whether each model currently holds a concave surface rather than a convex one.
+		self.__concaveModels = {}
+
+		# The version of the markup hull each model's surface was built from. The hulls are
+		# also updated for readouts and clipping, so their own change flag cannot be used.
+		self.__modelHullVersions = {}
+
+		# Concave surfaces keep Delaunay tetrahedra up to this many times the largest gap
+		# between a markup and its nearest neighbour. Smaller values follow concavities
+		# more closely, but may leave holes where markups are sparse.
+		self.concaveAlphaScale = 1.5
+
+	def clipVolumeWithModel(self, inputVolume, clippingModel, clipOutsideSurface, fillValue, outputVolume, cropToROI=False):
 		"""
 		Fill voxels of the input volume inside/outside the clipping model with the provided fill value
 		"""
-		
+
+		return self.clipVolumeWithModels(inputVolume, [clippingModel], clipOutsideSurface, fillValue, outputVolume, cropToROI)
+
+	def clipVolumeWithModels(self, inputVolume, clippingModels, clipOutsideSurface, fillValue, outputVolume, cropToROI=False):
+		"""
+		Fill voxels of the input volume inside/outside the union of the clipping models with the provided
+		fill value. The models' stencils are merged, so the volume is clipped in a single pass. If cropToROI and
+		clipOutsideSurface are both set, outputVolume only covers the bounding box of the models (see setClipOutput).
+		"""
+
+		stencil, modelExtent = self.getModelsStencil(inputVolume, clippingModels)
+
+		# The IJK bounding box of the model, so that later steps can work
+		# on that sub-extent only instead of on the whole volume.
+		if clipOutsideSurface:
+			roiExtent = modelExtent
+		else:
+			roiExtent = list(inputVolume.GetImageData().GetExtent())
+		cropped = cropToROI and clipOutsideSurface
+
+		outputImageData = self.clipImageWithStencil(inputVolume.GetImageData(), stencil, roiExtent, clipOutsideSurface, fillValue, cropped)
+
+		self.setClipOutput(outputVolume, inputVolume, outputImageData, roiExtent, cropped)
+
+		# Add a default display node to output volume node if it does not exist yet
+		if not outputVolume.GetDisplayNode:
+			displayNode=slicer.vtkMRMLScalarVolumeDisplayNode()
+			displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeGrey")
+			slicer.mrmlScene.AddNode(displayNode)
+			outputVolume.SetAndObserveDisplayNodeID(displayNode.GetID())
+
+		return True
+
+	def clipVolumesWithModels(self, inputVolumes, clippingModels, clipOutsideSurface, fillValues, outputVolumes, cropToROI=False, numberOfThreads=None):
+		"""
+		Clip each of inputVolumes into the matching outputVolume with the matching fill value, as
+		clipVolumeWithModels does. The stencil is built once for each voxel lattice, so that volumes on the
+		same lattice share it, and the volumes are clipped in a pool of numberOfThreads threads, by default
+		one per volume. Each job clips with its own shallow copy of the stencil; the cached one is not used
+		by any thread.
+		"""
+
+		stencils = {}
+		jobs = []
+		for inputVolume, fillValue in zip(inputVolumes, fillValues):
+			latticeKey = self.getLatticeKey(inputVolume)
+			if latticeKey not in stencils:
+				stencils[latticeKey] = self.getModelsStencil(inputVolume, clippingModels)
+			cachedStencil, modelExtent = stencils[latticeKey]
+
+			# Each thread gets its own stencil object, so that pipeline updates on one
+			# do not race with another; the shallow copy still shares the extents.
+			stencil = vtk.vtkImageStencilData()
+			stencil.ShallowCopy(cachedStencil)
+
+			if clipOutsideSurface:
+				roiExtent = list(modelExtent)
+			else:
+				roiExtent = list(inputVolume.GetImageData().GetExtent())
+			jobs.append([inputVolume.GetImageData(), stencil, roiExtent, fillValue])
+
+		cropped = cropToROI and clipOutsideSurface
+
+		def clipJob(job):
+			inputImage, stencil, roiExtent, fillValue = job
+			return self.clipImageWithStencil(inputImage, stencil, roiExtent, clipOutsideSurface, fillValue, cropped)
+
+		pool = ThreadPool(numberOfThreads or len(jobs))
+		try:
+			outputImages = pool.map(clipJob, jobs)
+		finally:
+			pool.close()
+			pool.join()
+
+		# MRML nodes are only modified from the main thread.
+		for inputVolume, outputVolume, outputImageData, job in zip(inputVolumes, outputVolumes, outputImages, jobs):
+			self.setClipOutput(outputVolume, inputVolume, outputImageData, job[2], cropped)
+
+		return True
+
+	def clipImageWithStencil(self, inputImage, stencil, roiExtent, clipOutsideSurface, fillValue, cropped):
+		"""
+		Return a copy of inputImage with the voxels inside/outside stencil set to fillValue. A cropped
+		copy only covers roiExtent, starting at IJK 0. Does not touch the scene, so it can run on any thread.
+		"""
+
+		# Apply the stencil to the volume
+		stencilToImage=vtk.vtkImageStencil()
+		if cropped:
+			# Only the bounding box is copied out of the volume and clipped.
+			cropToExtent = vtk.vtkImageClip()
+			cropToExtent.SetInputData(inputImage)
+			cropToExtent.SetOutputWholeExtent(roiExtent)
+			cropToExtent.ClipDataOn()
+			stencilToImage.SetInputConnection(cropToExtent.GetOutputPort())
+		else:
+			stencilToImage.SetInputData(inputImage)
+		stencilToImage.SetStencilData(stencil)
+		if clipOutsideSurface:
+			stencilToImage.ReverseStencilOff()
+		else:
+			stencilToImage.ReverseStencilOn()
+		stencilToImage.SetBackgroundValue(fillValue)
+
+		if cropped:
+			moveToOrigin = vtk.vtkImageChangeInformation()
+			moveToOrigin.SetInputConnection(stencilToImage.GetOutputPort())
+			moveToOrigin.SetOutputExtentStart(0, 0, 0)
+			moveToOrigin.Update()
+			clippedImage = moveToOrigin.GetOutput()
+		else:
+			stencilToImage.Update()
+			clippedImage = stencilToImage.GetOutput()
+
+		# A shallow copy takes over the filter's scalars without copying them,
+		# and detaches the result from the pipeline.
+		outputImageData = vtk.vtkImageData()
+		outputImageData.ShallowCopy(clippedImage)
+
+		return outputImageData
+
+	def setClipOutput(self, outputVolume, inputVolume, outputImageData, roiExtent, cropped):
+		"""
+		Give outputVolume the clipped outputImageData and record the IJK extent of the ROI, so that later
+		steps can work on that sub-extent only. A cropped outputImageData covers just roiExtent of inputVolume,
+		starting at IJK 0; its origin is moved to the corner of roiExtent, and the crop is recorded so that
+		results can be put back on the lattice of inputVolume with getUncroppedExtent.
+		"""
+
+		if cropped:
+			self.setExtentGeometry(outputVolume, inputVolume, roiExtent)
+			cropExtent = roiExtent
+			roiExtent = [0, roiExtent[1]-roiExtent[0], 0, roiExtent[3]-roiExtent[2], 0, roiExtent[5]-roiExtent[4]]
+			outputVolume.SetAttribute('CropExtent', ' '.join([str(x) for x in cropExtent]))
+			outputVolume.SetAttribute('CropSourceVolumeID', inputVolume.GetID())
+		else:
+			ijkToRas = vtk.vtkMatrix4x4()
+			inputVolume.GetIJKToRASMatrix( ijkToRas )
+			outputVolume.SetIJKToRASMatrix(ijkToRas)
+			outputVolume.SetAttribute('CropExtent', '')
+			outputVolume.SetAttribute('CropSourceVolumeID', '')
+
+		outputVolume.SetAttribute('ROIExtent', ' '.join([str(x) for x in roiExtent]))
+		outputVolume.SetAndObserveImageData(outputImageData)
+
+	def getUncroppedExtent(self, volumeNode, extent):
+		"""
+		Return [sourceVolume, extent]: the volume that volumeNode was cropped from by setClipOutput, and extent
+		moved onto its lattice. Volumes that were not cropped are returned unchanged.
+		"""
+
+		cropExtent = volumeNode.GetAttribute('CropExtent')
+		if cropExtent == None or cropExtent == '':
+			return [volumeNode, list(extent)]
+
+		cropExtent = [int(x) for x in cropExtent.split()]
+		sourceVolume = Helper.getNodeByID(volumeNode.GetAttribute('CropSourceVolumeID'))
+		return [sourceVolume, [extent[index] + cropExtent[index - index % 2] for index in range(6)]]
+
+	def getModelStencil(self, inputVolume, clippingModel):
+		"""
+		Return [stencil, extent]: the stencil of clippingModel on the voxel lattice of inputVolume,
+		and the IJK bounding extent of the model. Results are kept in a small least-recently-used
+		cache keyed on the model's geometry and the lattice, so any volume on the same lattice reuses them.
+		"""
+
 		# Determine the transform between the box and the image IJK coordinate systems
-		
-		rasToModel = vtk.vtkMatrix4x4()    
+
+		rasToModel = vtk.vtkMatrix4x4()
 		if clippingModel.GetTransformNodeID() != None:
 			modelTransformNode = slicer.mrmlScene.GetNodeByID(clippingModel.GetTransformNodeID())
 			boxToRas = vtk.vtkMatrix4x4()
 			modelTransformNode.GetMatrixTransformToWorld(boxToRas)
 			rasToModel.DeepCopy(boxToRas)
 			rasToModel.Invert()
-			
+
 		ijkToRas = vtk.vtkMatrix4x4()
 		inputVolume.GetIJKToRASMatrix( ijkToRas )
 
+		inputImage = inputVolume.GetImageData()
+		polyData = clippingModel.GetPolyData()
+
+		cacheKey = (clippingModel.GetID(),
+					polyData.GetMTime() if polyData != None else 0,
+					self.matrixToTuple(rasToModel)) + self.getLatticeKey(inputVolume)
+
+		if cacheKey in self.__stencilCache:
+			cached = self.__stencilCache.pop(cacheKey)
+			self.__stencilCache[cacheKey] = cached
+			return cached
+
 		ijkToModel = vtk.vtkMatrix4x4()
 		vtk.vtkMatrix4x4.Multiply4x4(rasToModel,ijkToRas,ijkToModel)
 		modelToIjkTransform = vtk.vtkTransform()
 		modelToIjkTransform.SetMatrix(ijkToModel)
 		modelToIjkTransform.Inverse()
-		
+
 		transformModelToIjk=vtk.vtkTransformPolyDataFilter()
 		transformModelToIjk.SetTransform(modelToIjkTransform)
 		transformModelToIjk.SetInputConnection(clippingModel.GetPolyDataConnection())
+		transformModelToIjk.Update()
+
+		modelExtent = self.boundsToExtent(transformModelToIjk.GetOutput().GetBounds(), inputImage.GetExtent())
 
-		# Use the stencil to fill the volume
-		
 		# Convert model to stencil
 		polyToStencil = vtk.vtkPolyDataToImageStencil()
 		polyToStencil.SetInputConnection(transformModelToIjk.GetOutputPort())
-		polyToStencil.SetOutputSpacing(inputVolume.GetImageData().GetSpacing())
-		polyToStencil.SetOutputOrigin(inputVolume.GetImageData().GetOrigin())
-		polyToStencil.SetOutputWholeExtent(inputVolume.GetImageData().GetExtent())
-		
-		# Apply the stencil to the volume
-		stencilToImage=vtk.vtkImageStencil()
-		stencilToImage.SetInputConnection(inputVolume.GetImageDataConnection())
-		stencilToImage.SetStencilConnection(polyToStencil.GetOutputPort())
-		if clipOutsideSurface:
-			stencilToImage.ReverseStencilOff()
+		polyToStencil.SetOutputSpacing(inputImage.GetSpacing())
+		polyToStencil.SetOutputOrigin(inputImage.GetOrigin())
+		polyToStencil.SetOutputWholeExtent(inputImage.GetExtent())
+		polyToStencil.Update()
+
+		stencil = vtk.vtkImageStencilData()
+		stencil.DeepCopy(polyToStencil.GetOutput())
+
+		self.__stencilCache[cacheKey] = [stencil, modelExtent]
+		while len(self.__stencilCache) > self.stencilCacheSize:
+			self.__stencilCache.popitem(last=False)
+
+		return [stencil, modelExtent]
+
+	def getModelsStencil(self, inputVolume, clippingModels):
+		"""
+		Return [stencil, extent] for the union of several clipping models: their stencils merged into one,
+		and the bounding extent shared by all of them. Models without any points are skipped.
+		"""
+
+		stencils = []
+		extents = []
+		for clippingModel in clippingModels:
+			polyData = clippingModel.GetPolyData()
+			if len(clippingModels) > 1 and (polyData == None or polyData.GetNumberOfPoints() == 0):
+				continue
+			stencil, modelExtent = self.getModelStencil(inputVolume, clippingModel)
+			stencils.append(stencil)
+			extents.append(modelExtent)
+
+		if stencils == []:
+			return self.getModelStencil(inputVolume, clippingModels[0])
+		if len(stencils) == 1:
+			return [stencils[0], extents[0]]
+
+		# Cached stencils are shared, so merge into a copy.
+		unionStencil = vtk.vtkImageStencilData()
+		unionStencil.DeepCopy(stencils[0])
+		for stencil in stencils[1:]:
+			unionStencil.Add(stencil)
+
+		return [unionStencil, self.unionExtent(extents)]
+
+	def getModelMask(self, inputVolume, clippingModel):
+		"""
+		Return [mask, extent] for clippingModel, in the same form as getHullMask.
+		"""
+
+		stencil, modelExtent = self.getModelStencil(inputVolume, clippingModel)
+
+		stencilToMask = vtk.vtkImageStencilToImage()
+		stencilToMask.SetInputData(stencil)
+		stencilToMask.SetOutputWholeExtent(modelExtent)
+		stencilToMask.SetInsideValue(1)
+		stencilToMask.SetOutsideValue(0)
+		stencilToMask.SetOutputScalarTypeToUnsignedChar()
+		stencilToMask.Update()
+
+		return [self.getExtentArray(stencilToMask.GetOutput()) > 0, modelExtent]
+
+	@staticmethod
+	def unionExtent(extents):
+		extent = list(extents[0])
+		for other in extents[1:]:
+			for axis in range(3):
+				extent[2*axis] = min(extent[2*axis], other[2*axis])
+				extent[2*axis+1] = max(extent[2*axis+1], other[2*axis+1])
+		return extent
+
+	def createComponentsLabel(self, templateVolume, masks, name, labelNode=None):
+		"""
+		Write a label map in which the voxels of the i-th [mask, extent] in masks have the value i+1, over the
+		extent shared by all masks. Where ROIs overlap, the later ROI wins. A new label volume is created
+		unless labelNode is given.
+		"""
+
+		extent = self.unionExtent([maskExtent for mask, maskExtent in masks])
+
+		if labelNode == None:
+			labelNode = self.createLabelVolume(templateVolume, extent, name)
 		else:
-			stencilToImage.ReverseStencilOn()
-		stencilToImage.SetBackgroundValue(fillValue)
-		stencilToImage.Update()
+			labelImage = vtk.vtkImageData()
+			labelImage.SetDimensions(extent[1]-extent[0]+1, extent[3]-extent[2]+1, extent[5]-extent[4]+1)
+			labelImage.AllocateScalars(vtk.VTK_SHORT, 1)
+			self.setExtentGeometry(labelNode, templateVolume, extent)
+			labelNode.SetAndObserveImageData(labelImage)
+
+		labels = self.getExtentArray(labelNode.GetImageData())
+		labels[:] = 0
+		for index, (mask, maskExtent) in enumerate(masks):
+			block = labels[maskExtent[4]-extent[4]:maskExtent[5]-extent[4]+1,
+						   maskExtent[2]-extent[2]:maskExtent[3]-extent[2]+1,
+						   maskExtent[0]-extent[0]:maskExtent[1]-extent[0]+1]
+			block[mask] = index + 1
+
+		labelNode.GetImageData().Modified()
+		return labelNode
+
+	def getMarkupCoordinates(self, inputMarkup):
+		coordinates = []
+		new_coord = [0.0, 0.0, 0.0]
+		for i in range(inputMarkup.GetNumberOfFiducials()):
+			inputMarkup.GetNthFiducialPosition(i,new_coord)
+			coordinates.append(list(new_coord))
+		return coordinates
+
+	def getMarkupHull(self, inputMarkup):
+		"""
+		Return the convex hull of the points in the input markup list, brought up to date incrementally.
+		"""
+
+		hull = self.__markupHulls.setdefault(inputMarkup.GetID(), IncrementalConvexHull())
+		hull.update(self.getMarkupCoordinates(inputMarkup))
+		return hull
+
+	def getHullExtent(self, inputVolume, hull):
+		"""
+		Return the IJK bounding extent of a convex hull in inputVolume.
+		"""
+
+		rasToIjk = vtk.vtkMatrix4x4()
+		inputVolume.GetRASToIJKMatrix(rasToIjk)
+		rasToIjk = numpy.array([[rasToIjk.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+		points = hull.points()
+		ijkPoints = numpy.dot(points, rasToIjk[:3,:3].T) + rasToIjk[:3,3]
+		bounds = []
+		for axis in range(3):
+			bounds += [ijkPoints[:,axis].min(), ijkPoints[:,axis].max()]
+		return self.boundsToExtent(bounds, inputVolume.GetImageData().GetExtent())
+
+	def getHullMask(self, inputVolume, hull, step=1):
+		"""
+		Voxelize a convex hull straight from its plane equations, with no mesh or stencil in between.
+		Return [mask, extent]: extent is the hull's IJK bounding extent in inputVolume, and mask a boolean
+		array indexed [k,j,i] over that extent that is True for voxel centers inside every half-space.
+		With step above 1, mask only covers every step-th voxel along each axis, from the corner of extent.
+		"""
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		inputVolume.GetIJKToRASMatrix(ijkToRas)
+		ijkToRas = numpy.array([[ijkToRas.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+		extent = self.getHullExtent(inputVolume, hull)
+
+		# A RAS half-space n.x <= d becomes (n A).ijk <= d - n.t in IJK, for ijkToRas = [A t].
+		normals, offsets = hull.planes()
+		ijkNormals = numpy.dot(normals, ijkToRas[:3,:3])
+		ijkOffsets = offsets - numpy.dot(normals, ijkToRas[:3,3])
+		tolerance = 1e-9 * (abs(ijkOffsets).max() + 1)
+
+		i = numpy.arange(extent[0], extent[1]+1, step)
+		j = numpy.arange(extent[2], extent[3]+1, step)
+		k = numpy.arange(extent[4], extent[5]+1, step)
+
+		mask = numpy.ones((len(k), len(j), len(i)), dtype=bool)
+		for normal, offset in zip(ijkNormals, ijkOffsets):
+			mask &= (normal[0]*i)[None,None,:] + (normal[1]*j)[None,:,None] + (normal[2]*k)[:,None,None] <= offset + tolerance
+
+		return [mask, extent]
+
+	def getBoxMask(self, inputVolume, center, radius):
+		"""
+		Return [mask, extent] for an axis-aligned RAS box, such as an annotation ROI, given by its center
+		and its half-widths in radius, in the same form as getHullMask.
+		"""
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		inputVolume.GetIJKToRASMatrix(ijkToRas)
+		rasToIjk = vtk.vtkMatrix4x4()
+		vtk.vtkMatrix4x4.Invert(ijkToRas, rasToIjk)
+
+		corners = [rasToIjk.MultiplyPoint([center[0] + x*radius[0], center[1] + y*radius[1], center[2] + z*radius[2], 1])[:3]
+				   for x in [-1, 1] for y in [-1, 1] for z in [-1, 1]]
+		bounds = []
+		for axis in range(3):
+			bounds += [min([corner[axis] for corner in corners]), max([corner[axis] for corner in corners])]
+		extent = self.boundsToExtent(bounds, inputVolume.GetImageData().GetExtent())
+
+		ijkToRas = numpy.array([[ijkToRas.GetElement(row, column) for column in range(4)] for row in range(4)])
+		i = numpy.arange(extent[0], extent[1]+1)
+		j = numpy.arange(extent[2], extent[3]+1)
+		k = numpy.arange(extent[4], extent[5]+1)
+
+		mask = numpy.ones((len(k), len(j), len(i)), dtype=bool)
+		for axis in range(3):
+			ras = (ijkToRas[axis,0]*i)[None,None,:] + (ijkToRas[axis,1]*j)[None,:,None] + (ijkToRas[axis,2]*k)[:,None,None] + ijkToRas[axis,3]
+			mask &= abs(ras - center[axis]) <= radius[axis]
+
+		return [mask, extent]
+
+	def getHullStatistics(self, inputVolume, hull, maximumSamples=100000):
+		"""
+		Estimate the number of voxels of inputVolume inside a convex hull, their volume in mL, and their mean
+		and maximum intensity, without clipping. At most about maximumSamples voxels of the hull's bounding
+		box are tested, taking every step-th voxel along each axis. Returns None if the hull is not valid.
+		"""
+
+		if not hull.isValid():
+			return None
+
+		extent = self.getHullExtent(inputVolume, hull)
+		boxVoxels = float(extent[1]-extent[0]+1) * (extent[3]-extent[2]+1) * (extent[5]-extent[4]+1)
+		step = max(1, int(math.ceil((boxVoxels / maximumSamples) ** (1.0/3))))
+
+		mask, extent = self.getHullMask(inputVolume, hull, step)
+		values = self.getExtentArray(inputVolume.GetImageData(), extent)[::step,::step,::step][mask]
+
+		# Each sample stands for a step x step x step block of voxels.
+		spacing = inputVolume.GetSpacing()
+		voxels = int(values.size) * step**3
+		statistics = {'voxels': voxels, 'milliliters': voxels * spacing[0] * spacing[1] * spacing[2] / 1000.0,
+					  'mean': None, 'max': None, 'step': step}
+		if values.size > 0:
+			statistics['mean'] = float(values.mean())
+			statistics['max'] = float(values.max())
+
+		return statistics
+
+	def clipVolumeWithMarkupHull(self, inputVolume, inputMarkup, clipOutsideSurface, fillValue, outputVolume, cropToROI=False):
+		"""
+		Fill voxels of the input volume inside/outside the convex hull of the markup points with the provided
+		fill value. Faster than clipVolumeWithModel, as no surface is built or rasterized, but follows the
+		exact hull rather than the smoothed surface. Returns False, leaving outputVolume alone, if the
+		markups do not span a volume.
+		"""
+
+		return self.clipVolumeWithMarkupHulls(inputVolume, [inputMarkup], clipOutsideSurface, fillValue, outputVolume, cropToROI)
+
+	def clipVolumeWithMarkupHulls(self, inputVolume, inputMarkups, clipOutsideSurface, fillValue, outputVolume, cropToROI=False):
+		"""
+		As clipVolumeWithMarkupHull, for the union of the hulls of several markup lists. Returns False if any
+		of them does not span a volume.
+		"""
+
+		masks = []
+		for inputMarkup in inputMarkups:
+			hull = self.getMarkupHull(inputMarkup)
+			if not hull.isValid():
+				return False
+			masks.append(self.getHullMask(inputVolume, hull))
+
+		mask, hullExtent = self.unionMasks(masks)
+		if mask is None:
+			return False
+
+		return self.clipVolumeWithMask(inputVolume, mask, hullExtent, clipOutsideSurface, fillValue, outputVolume, cropToROI)
+
+	def unionMasks(self, masks):
+		"""
+		Return [mask, extent] for the union of a list of [mask, extent], over the extent shared by all of them.
+		Both are None if the list is empty.
+		"""
+
+		if masks == []:
+			return [None, None]
+
+		unionExtent = self.unionExtent([maskExtent for mask, maskExtent in masks])
+		union = numpy.zeros((unionExtent[5]-unionExtent[4]+1, unionExtent[3]-unionExtent[2]+1, unionExtent[1]-unionExtent[0]+1), dtype=bool)
+		for mask, maskExtent in masks:
+			union[maskExtent[4]-unionExtent[4]:maskExtent[5]-unionExtent[4]+1,
+				  maskExtent[2]-unionExtent[2]:maskExtent[3]-unionExtent[2]+1,
+				  maskExtent[0]-unionExtent[0]:maskExtent[1]-unionExtent[0]+1] |= mask
+
+		return [union, unionExtent]
+
+	def getROIMasks(self, inputVolume, inputMarkups, clippingModels, useHulls=False):
+		"""
+		Return a [mask, extent] for each ROI on the lattice of inputVolume: the convex hulls of inputMarkups
+		if useHulls is set and they all span a volume, otherwise those of clippingModels that have points.
+		"""
+
+		if useHulls:
+			hulls = [self.getMarkupHull(inputMarkup) for inputMarkup in inputMarkups]
+			if all([hull.isValid() for hull in hulls]):
+				return [self.getHullMask(inputVolume, hull) for hull in hulls]
+
+		return [self.getModelMask(inputVolume, clippingModel) for clippingModel in clippingModels
+				if clippingModel.GetPolyData() != None and clippingModel.GetPolyData().GetNumberOfPoints() > 0]
+
+	def getROIMask(self, inputVolume, inputMarkups, clippingModels, useHulls=False, margin=0):
+		"""
+		Return [mask, extent] for the union of the ROIs of getROIMasks. A non-zero margin then grows or
+		shrinks the union by that many mm (see getMarginMask). Both are None if there is no ROI, i.e. no
+		hulls are used and no model has points.
+		"""
+
+		mask, extent = self.unionMasks(self.getROIMasks(inputVolume, inputMarkups, clippingModels, useHulls))
+		if mask is not None and margin != 0:
+			mask, extent = self.getMarginMask(inputVolume, mask, extent, margin)
+
+		return [mask, extent]
+
+	def getROIComponentMasks(self, inputVolume, inputMarkups, clippingModels, useHulls=False, margin=0):
+		"""
+		Return a [mask, extent] for each ROI, for createComponentsLabel, that together cover the mask of
+		getROIMask with the same arguments, margin included. With a positive margin each ROI is grown by it.
+		With a negative one each ROI keeps what is left of it inside the shrunk union, since overlapping
+		ROIs only lose voxels where their union ends.
+		"""
+
+		masks = self.getROIMasks(inputVolume, inputMarkups, clippingModels, useHulls)
+		if margin == 0 or masks == []:
+			return masks
+
+		unionMask, unionExtent = self.unionMasks(masks)
+		unionMask, unionExtent = self.getMarginMask(inputVolume, unionMask, unionExtent, margin)
+
+		componentMasks = []
+		for mask, extent in masks:
+			if margin > 0:
+				mask, extent = self.getMarginMask(inputVolume, mask, extent, margin)
+			componentMasks.append(self.restrictMask(mask, extent, unionMask, unionExtent))
+		return componentMasks
+
+	@staticmethod
+	def restrictMask(mask, extent, regionMask, regionExtent):
+		"""
+		Return [mask, extent] for the part of mask inside regionMask, over regionExtent.
+		"""
+
+		restricted = numpy.zeros(regionMask.shape, dtype=bool)
+		overlap = []
+		for axis in range(3):
+			overlap += [max(extent[2*axis], regionExtent[2*axis]), min(extent[2*axis+1], regionExtent[2*axis+1])]
+			if overlap[2*axis] > overlap[2*axis+1]:
+				return [restricted, list(regionExtent)]
+
+		restricted[overlap[4]-regionExtent[4]:overlap[5]-regionExtent[4]+1,
+				   overlap[2]-regionExtent[2]:overlap[3]-regionExtent[2]+1,
+				   overlap[0]-regionExtent[0]:overlap[1]-regionExtent[0]+1] = \
+			mask[overlap[4]-extent[4]:overlap[5]-extent[4]+1,
+				 overlap[2]-extent[2]:overlap[3]-extent[2]+1,
+				 overlap[0]-extent[0]:overlap[1]-extent[0]+1]
+
+		return [restricted & regionMask, list(regionExtent)]
+
+	def getMarginMask(self, inputVolume, mask, extent, margin):
+		"""
+		Grow (margin > 0) or shrink (margin < 0) the ROI [mask, extent] on the lattice of inputVolume by
+		margin mm. Voxels are kept by their distance to the ROI's surface, taken from a distance map of
+		the mask's bounding box padded by the margin, so only that box is looked at. Returns [mask, extent]
+		for the new ROI, within the volume.
+		"""
+
+		spacing = inputVolume.GetSpacing()
+		wholeExtent = inputVolume.GetImageData().GetExtent()
+
+		paddedExtent = []
+		for axis in range(3):
+			padding = int(math.ceil(abs(margin) / spacing[axis])) + 1
+			paddedExtent += [max(extent[2*axis] - padding, wholeExtent[2*axis]), min(extent[2*axis+1] + padding, wholeExtent[2*axis+1])]
+
+		padded = numpy.zeros((paddedExtent[5]-paddedExtent[4]+1, paddedExtent[3]-paddedExtent[2]+1, paddedExtent[1]-paddedExtent[0]+1), dtype=bool)
+		padded[extent[4]-paddedExtent[4]:extent[5]-paddedExtent[4]+1,
+			   extent[2]-paddedExtent[2]:extent[3]-paddedExtent[2]+1,
+			   extent[0]-paddedExtent[0]:extent[1]-paddedExtent[0]+1] = mask
+
+		if margin > 0:
+			marginMask = self.getDistanceMap(padded, spacing) <= margin
+		else:
+			marginMask = self.getDistanceMap(~padded, spacing) > -margin
+
+		if not marginMask.any():
+			return [marginMask, paddedExtent]
+
+		# Trim to the bounding box of what is left.
+		trimmedExtent = []
+		for axis, otherAxes in [[2, (0, 1)], [1, (0, 2)], [0, (1, 2)]]:
+			indices = numpy.nonzero(marginMask.any(axis=otherAxes))[0]
+			trimmedExtent += [paddedExtent[2*(2-axis)] + int(indices[0]), paddedExtent[2*(2-axis)] + int(indices[-1])]
+
+		marginMask = marginMask[trimmedExtent[4]-paddedExtent[4]:trimmedExtent[5]-paddedExtent[4]+1,
+								trimmedExtent[2]-paddedExtent[2]:trimmedExtent[3]-paddedExtent[2]+1,
+								trimmedExtent[0]-paddedExtent[0]:trimmedExtent[1]-paddedExtent[0]+1]
+
+		return [marginMask, trimmedExtent]
+
+	def getDistanceMap(self, mask, spacing):
+		"""
+		Return the Euclidean distance in mm from each voxel of mask, indexed [k,j,i], to the nearest True
+		voxel, for voxel spacing (i, j, k). The exact transform is separable into one pass along each axis,
+		each computing the lower envelope of parabolas (Felzenszwalb and Huttenlocher), which takes time
+		linear in the number of voxels. If mask has no True voxel, all distances are beyond the box.
+		"""
+
+		# Finite, so that the envelope arithmetic stays exact, but beyond any distance in the box.
+		far = 4 * sum([(mask.shape[2-axis] * spacing[axis])**2 for axis in range(3)]) + 1
+		squaredDistance = numpy.where(mask, 0.0, far)
+
+		for axis in range(3):
+			squaredDistance = self.__squaredDistanceAlongAxis(squaredDistance, 2-axis, spacing[axis])
+
+		return numpy.sqrt(squaredDistance)
+
+	def __squaredDistanceAlongAxis(self, squaredDistance, axis, spacing):
+
+		# Each line along axis is transformed on its own, but all lines are stepped through together.
+		lines = numpy.ascontiguousarray(numpy.swapaxes(squaredDistance, axis, -1))
+		shape = lines.shape
+		f = lines.reshape(-1, shape[-1])
+		numberOfLines, length = f.shape
+		rows = numpy.arange(numberOfLines)
+		weight = float(spacing)**2
+
+		# v holds the positions of the parabolas in the lower envelope of each line, k the index of
+		# the last one, and the envelope switches from parabola v[k-1] to v[k] at position z[k].
+		v = numpy.zeros((numberOfLines, length), dtype=numpy.int64)
+		z = numpy.empty((numberOfLines, length+1))
+		z[:,0] = -numpy.inf
+		z[:,1] = numpy.inf
+		k = numpy.zeros(numberOfLines, dtype=numpy.int64)
+
+		for q in range(1, length):
+			p = v[rows, k]
+			s = ((f[:,q] + weight*q*q) - (f[rows,p] + weight*p*p)) / (2*weight*(q - p))
+			hidden = s <= z[rows, k]
+			while hidden.any():
+				hiddenRows = rows[hidden]
+				k[hiddenRows] -= 1
+				p = v[hiddenRows, k[hiddenRows]]
+				s[hiddenRows] = ((f[hiddenRows,q] + weight*q*q) - (f[hiddenRows,p] + weight*p*p)) / (2*weight*(q - p))
+				hidden[hiddenRows] = s[hiddenRows] <= z[hiddenRows, k[hiddenRows]]
+			k += 1
+			v[rows, k] = q
+			z[rows, k] = s
+			z[rows, k+1] = numpy.inf
+
+		result = numpy.empty_like(f)
+		k[:] = 0
+		for q in range(length):
+			behind = z[rows, k+1] < q
+			while behind.any():
+				k[behind] += 1
+				behind = z[rows, k+1] < q
+			p = v[rows, k]
+			result[:,q] = weight*(q - p)**2 + f[rows, p]
+
+		return numpy.swapaxes(result.reshape(shape), axis, -1)
+
+	def clipVolumeWithMask(self, inputVolume, mask, maskExtent, clipOutsideSurface, fillValue, outputVolume, cropToROI=False):
+		"""
+		Fill voxels of the input volume inside/outside a [mask, extent] on its lattice with the provided fill
+		value, as clipVolumeWithModel does.
+		"""
+
+		inputImage = inputVolume.GetImageData()
+		inputBlock = self.getExtentArray(inputImage, maskExtent)
 
-		# Update the volume with the stencil operation result
 		outputImageData = vtk.vtkImageData()
-		outputImageData.DeepCopy(stencilToImage.GetOutput())
-		
-		outputVolume.SetAndObserveImageData(outputImageData);
-		outputVolume.SetIJKToRASMatrix(ijkToRas)
+		if cropToROI and clipOutsideSurface:
+			outputImageData.SetDimensions(mask.shape[2], mask.shape[1], mask.shape[0])
+			outputImageData.AllocateScalars(inputImage.GetScalarType(), 1)
+			outputBlock = self.getExtentArray(outputImageData)
+			outputBlock[:] = fillValue
+			outputBlock[mask] = inputBlock[mask]
+			self.setClipOutput(outputVolume, inputVolume, outputImageData, maskExtent, True)
+			return True
 
-		# Add a default display node to output volume node if it does not exist yet
-		if not outputVolume.GetDisplayNode:
-			displayNode=slicer.vtkMRMLScalarVolumeDisplayNode()
-			displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeGrey")
-			slicer.mrmlScene.AddNode(displayNode)
-			outputVolume.SetAndObserveDisplayNodeID(displayNode.GetID())
+		outputImageData.CopyStructure(inputImage)
+		outputImageData.AllocateScalars(inputImage.GetScalarType(), 1)
+		outputBlock = self.getExtentArray(outputImageData, maskExtent)
+
+		if clipOutsideSurface:
+			self.getExtentArray(outputImageData)[:] = fillValue
+			outputBlock[mask] = inputBlock[mask]
+			roiExtent = maskExtent
+		else:
+			self.getExtentArray(outputImageData)[:] = self.getExtentArray(inputImage)
+			outputBlock[mask] = fillValue
+			roiExtent = list(inputImage.GetExtent())
+
+		self.setClipOutput(outputVolume, inputVolume, outputImageData, roiExtent, False)
 
 		return True
 
-	def updateModelFromMarkup(self, inputMarkup, outputModel):
+	def benchmarkHullClip(self, inputVolume, inputMarkup, clippingModel):
+		"""
+		Time voxelizing the markup hull from its planes against rasterizing clippingModel into a stencil,
+		and measure how well the two masks agree. clippingModel is normally the subdivided surface, which
+		bulges a little past the hull, so agreement is high but not exact.
+		"""
+
+		inputImage = inputVolume.GetImageData()
+		wholeExtent = inputImage.GetExtent()
+
+		startTime = time.time()
+		self.__stencilCache.clear()
+		stencil, modelExtent = self.getModelStencil(inputVolume, clippingModel)
+		stencilToMask = vtk.vtkImageStencilToImage()
+		stencilToMask.SetInputData(stencil)
+		stencilToMask.SetInsideValue(1)
+		stencilToMask.SetOutsideValue(0)
+		stencilToMask.SetOutputScalarTypeToUnsignedChar()
+		stencilToMask.Update()
+		stencilTime = time.time() - startTime
+
+		startTime = time.time()
+		hull = IncrementalConvexHull()
+		hull.setPoints(self.getMarkupCoordinates(inputMarkup))
+		hullMask, hullExtent = self.getHullMask(inputVolume, hull)
+		halfSpaceTime = time.time() - startTime
+
+		stencilMask = self.getExtentArray(stencilToMask.GetOutput()) > 0
+		fullHullMask = numpy.zeros(stencilMask.shape, dtype=bool)
+		fullHullMask[hullExtent[4]-wholeExtent[4]:hullExtent[5]-wholeExtent[4]+1,
+					 hullExtent[2]-wholeExtent[2]:hullExtent[3]-wholeExtent[2]+1,
+					 hullExtent[0]-wholeExtent[0]:hullExtent[1]-wholeExtent[0]+1] = hullMask
+
+		stencilVoxels = int(stencilMask.sum())
+		halfSpaceVoxels = int(fullHullMask.sum())
+		overlap = int((stencilMask & fullHullMask).sum())
+		dice = 2.0 * overlap / max(stencilVoxels + halfSpaceVoxels, 1)
+
+		return {'stencilSeconds': stencilTime, 'halfSpaceSeconds': halfSpaceTime,
+				'stencilVoxels': stencilVoxels, 'halfSpaceVoxels': halfSpaceVoxels, 'dice': dice}
+
+	def getLatticeKey(self, inputVolume):
+		"""
+		A hashable description of the voxel lattice of inputVolume. Volumes with equal keys share stencils.
+		"""
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		inputVolume.GetIJKToRASMatrix( ijkToRas )
+
+		inputImage = inputVolume.GetImageData()
+		return (self.matrixToTuple(ijkToRas),
+				tuple(inputImage.GetExtent()),
+				tuple(inputImage.GetSpacing()),
+				tuple(inputImage.GetOrigin()))
+
+	@staticmethod
+	def matrixToTuple(matrix):
+		return tuple([matrix.GetElement(row, column) for row in range(4) for column in range(4)])
+
+	def boundsToExtent(self, bounds, wholeExtent):
+		"""
+		Convert IJK bounds to the smallest voxel extent that contains them, clamped to wholeExtent.
+		If the bounds miss the volume entirely, the whole extent is returned.
+		"""
+
+		extent = []
+		for axis in range(3):
+			extent.append(max(int(math.floor(bounds[2*axis])), wholeExtent[2*axis]))
+			extent.append(min(int(math.ceil(bounds[2*axis+1])), wholeExtent[2*axis+1]))
+
+		for axis in range(3):
+			if extent[2*axis] > extent[2*axis+1]:
+				return list(wholeExtent)
+
+		return extent
+
+	def getROIExtent(self, volumeNode):
+		"""
+		Return the ROI extent recorded by clipVolumeWithModel, or the whole extent if there is none.
+		"""
+
+		roiExtent = volumeNode.GetAttribute('ROIExtent')
+		if roiExtent == None or roiExtent == '':
+			return list(volumeNode.GetImageData().GetExtent())
+		return [int(x) for x in roiExtent.split()]
+
+	@staticmethod
+	def getExtentArray(imageData, extent=None):
+		"""
+		Return a numpy view of the voxels of imageData inside extent, indexed [k,j,i].
+		"""
+
+		wholeExtent = imageData.GetExtent()
+		dimensions = imageData.GetDimensions()
+		array = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
+		array = array.reshape(dimensions[2], dimensions[1], dimensions[0], -1)[:,:,:,0]
+
+		if extent == None:
+			return array
+
+		return array[extent[4]-wholeExtent[4]:extent[5]-wholeExtent[4]+1,
+					 extent[2]-wholeExtent[2]:extent[3]-wholeExtent[2]+1,
+					 extent[0]-wholeExtent[0]:extent[1]-wholeExtent[0]+1]
+
+	def getExtentScalarRange(self, volumeNode, extent):
+		"""
+		Scalar range of volumeNode within extent, without scanning the rest of the volume.
+		"""
+
+		array = self.getExtentArray(volumeNode.GetImageData(), extent)
+		return [float(array.min()), float(array.max())]
+
+	def setExtentGeometry(self, volumeNode, templateVolume, extent):
+		"""
+		Give volumeNode the geometry of the extent sub-block of templateVolume. Image data of such
+		nodes starts at IJK 0, so the IJK to RAS matrix is shifted to the corner of the extent.
+		"""
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		templateVolume.GetIJKToRASMatrix(ijkToRas)
+
+		corner = ijkToRas.MultiplyPoint([extent[0], extent[2], extent[4], 1])
+		for row in range(3):
+			ijkToRas.SetElement(row, 3, corner[row])
+
+		volumeNode.SetIJKToRASMatrix(ijkToRas)
+
+	def createLabelVolume(self, templateVolume, extent, name):
+		"""
+		Create an empty label volume covering only the extent sub-block of templateVolume.
+		"""
+
+		labelImage = vtk.vtkImageData()
+		labelImage.SetDimensions(extent[1]-extent[0]+1, extent[3]-extent[2]+1, extent[5]-extent[4]+1)
+		labelImage.AllocateScalars(vtk.VTK_SHORT, 1)
+		numpy_support.vtk_to_numpy(labelImage.GetPointData().GetScalars())[:] = 0
+
+		labelNode = slicer.vtkMRMLLabelMapVolumeNode()
+		labelNode.SetName(slicer.mrmlScene.GetUniqueNameByString(name))
+		slicer.mrmlScene.AddNode(labelNode)
+		labelNode.CreateDefaultDisplayNodes()
+
+		self.setExtentGeometry(labelNode, templateVolume, extent)
+		labelNode.SetAndObserveImageData(labelImage)
+
+		return labelNode
+
+	def padLabelToVolume(self, labelNode, templateVolume, extent):
+		"""
+		Place a label covering the extent sub-block of templateVolume back into a label with the full
+		extent and geometry of templateVolume. Only needed where full-size labels are required,
+		for example by the Editor.
+		"""
+
+		wholeExtent = templateVolume.GetImageData().GetExtent()
+		if list(labelNode.GetImageData().GetDimensions()) == list(templateVolume.GetImageData().GetDimensions()):
+			return
+
+		moveToExtent = vtk.vtkImageChangeInformation()
+		moveToExtent.SetInputData(labelNode.GetImageData())
+		moveToExtent.SetOutputExtentStart(extent[0], extent[2], extent[4])
+
+		pad = vtk.vtkImageConstantPad()
+		pad.SetInputConnection(moveToExtent.GetOutputPort())
+		pad.SetOutputWholeExtent(wholeExtent)
+		pad.SetConstant(0)
+		pad.Update()
+
+		ijkToRas = vtk.vtkMatrix4x4()
+		templateVolume.GetIJKToRASMatrix(ijkToRas)
+
+		labelNode.SetAndObserveImageData(pad.GetOutput())
+		labelNode.SetIJKToRASMatrix(ijkToRas)
+
+	def updateModelFromMarkup(self, inputMarkup, outputModel, subdivide=True, concave=False):
+		"""
+		Update model to enclose all points in the input markup list. With subdivide off, the raw hull
+		is used instead of the smooth subdivided surface, which is much faster to build while points
+		are being dragged. Clipping should always be done with a subdivided model. With concave on,
+		the model is the alpha shape of the points (see getConcaveSurface), if there is one.
 		"""
-		Update model to enclose all points in the input markup list
+
+		request = self.getModelRequest(inputMarkup, outputModel, subdivide, concave)
+		if request == None:
+			return
+
+		self.setModelSurface(outputModel, self.buildModelSurface(request), request)
+
+	def getModelRequest(self, inputMarkup, outputModel, subdivide=True, concave=False):
 		"""
-		
+		Collect what buildModelSurface needs to rebuild outputModel from the input markup list, or return
+		None if the model is already up to date or there are too few points. Reads the scene, so it has to
+		be called on the main thread; buildModelSurface can then run on any thread.
+		"""
+
 		# Delaunay triangulation is robust and creates nice smooth surfaces from a small number of points,
 		# however it can only generate convex surfaces robustly.
 		useDelaunay = True
-		
-		# Create polydata point set from markup points
-		
-		points = vtk.vtkPoints()
-		cellArray = vtk.vtkCellArray()
-		
+
 		numberOfPoints = inputMarkup.GetNumberOfFiducials()
 
 		# Surface generation algorithms behave unpredictably when there are not enough points
 		# return if there are very few points
 		if useDelaunay:
 			if numberOfPoints<3:
-				return
+				return None
 		else:
 			if numberOfPoints<10:
-				return
+				return None
 
-		points.SetNumberOfPoints(numberOfPoints)
-		new_coord = [0.0, 0.0, 0.0]
+		coordinates = self.getMarkupCoordinates(inputMarkup)
+		hullPolyData = None
+		hullVersion = None
+
+		if useDelaunay:
+
+			# Adding or moving one point only touches the hull faces that point can see,
+			# so most edits skip the tetrahedralization altogether.
+			hull = self.__markupHulls.setdefault(inputMarkup.GetID(), IncrementalConvexHull())
+			hull.update(coordinates)
+			hullVersion = hull.version()
+			hullChanged = self.__modelHullVersions.get(outputModel.GetID()) != hullVersion
+
+			# Markup nodes are also modified by selection and display changes. Concave surfaces
+			# also depend on the points inside the hull, so they are always rebuilt.
+			upToDate = self.__subdividedModels.get(outputModel.GetID(), False) or not subdivide
+			upToDate = upToDate and not concave and not self.__concaveModels.get(outputModel.GetID(), False)
+			if not hullChanged and upToDate and outputModel.GetPolyData() != None and outputModel.GetPolyData().GetNumberOfPoints() > 0:
+				return None
+
+			if hull.isValid():
+				hullPolyData = hull.polyData()
+
+		return {'coordinates': coordinates, 'hullPolyData': hullPolyData, 'useDelaunay': useDelaunay,
+				'subdivide': subdivide, 'concave': concave, 'hullVersion': hullVersion}
+
+	def buildModelSurface(self, request, isObsolete=None):
+		"""
+		Build the surface described by a request from getModelRequest. Does not touch the scene, so it can
+		run on a worker thread. isObsolete is checked between stages, and None is returned as soon as it
+		is true, since a newer request will replace this surface anyway.
+		"""
+
+		coordinates = request['coordinates']
+		subdivide = request['subdivide']
+
+		# Create polydata point set from markup points
+
+		points = vtk.vtkPoints()
+		cellArray = vtk.vtkCellArray()
 
+		numberOfPoints = len(coordinates)
+		points.SetNumberOfPoints(numberOfPoints)
 		for i in range(numberOfPoints):
-			inputMarkup.GetNthFiducialPosition(i,new_coord)
-			points.SetPoint(i, new_coord)
+			points.SetPoint(i, coordinates[i])
 
 		cellArray.InsertNextCell(numberOfPoints)
 		for i in range(numberOfPoints):
@@ -122,26 +1003,50 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
 		pointPolyData.SetLines(cellArray)
 		pointPolyData.SetPoints(points)
 
-		
 		# Create surface from point set
 
-		if useDelaunay:
-					
+		if request['concave'] and numberOfPoints >= 4:
+			surface = self.getConcaveSurface(coordinates, subdivide)
+			if surface != None:
+				return surface
+
+		if isObsolete != None and isObsolete():
+			return None
+
+		if request['useDelaunay'] and request['hullPolyData'] != None:
+
+			if subdivide:
+				smoother = vtk.vtkButterflySubdivisionFilter()
+				smoother.SetInputData(request['hullPolyData'])
+				smoother.SetNumberOfSubdivisions(3)
+				smoother.Update()
+				output = smoother.GetOutput()
+			else:
+				output = request['hullPolyData']
+
+		elif request['useDelaunay']:
+
+			# Fewer than four points, or all points in a plane: no hull to speak of.
 			delaunay = vtk.vtkDelaunay3D()
 			delaunay.SetInputData(pointPolyData)
 
 			surfaceFilter = vtk.vtkDataSetSurfaceFilter()
 			surfaceFilter.SetInputConnection(delaunay.GetOutputPort())
+			surfaceFilter.Update()
+			output = surfaceFilter.GetOutput()
+
+			if subdivide:
+				if isObsolete != None and isObsolete():
+					return None
 
-			smoother = vtk.vtkButterflySubdivisionFilter()
-			smoother.SetInputConnection(surfaceFilter.GetOutputPort())
-			smoother.SetNumberOfSubdivisions(3)
-			smoother.Update()
+				smoother = vtk.vtkButterflySubdivisionFilter()
+				smoother.SetInputConnection(surfaceFilter.GetOutputPort())
+				smoother.SetNumberOfSubdivisions(3)
+				smoother.Update()
+				output = smoother.GetOutput()
 
-			outputModel.SetPolyDataConnection(smoother.GetOutputPort())
-			
 		else:
-			
+
 			surf = vtk.vtkSurfaceReconstructionFilter()
 			surf.SetInputData(pointPolyData)
 			surf.SetNeighborhoodSize(20)
@@ -158,8 +1063,30 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
 			reverse.SetInputConnection(cf.GetOutputPort())
 			reverse.ReverseCellsOff()
 			reverse.ReverseNormalsOff()
+			reverse.Update()
+			output = reverse.GetOutput()
+
+		# Detached from the filters, so the model does not re-execute them on the main thread.
+		surface = vtk.vtkPolyData()
+		surface.ShallowCopy(output)
+		return surface
+
+	def setModelSurface(self, outputModel, surface, request=None):
+		"""
+		Show a surface from buildModelSurface in outputModel. Has to be called on the main thread. Give the
+		request the surface was built for, so that getModelRequest knows what the model now holds; until
+		then, the model is rebuilt on the next request.
+		"""
+
+		if surface == None:
+			return
 
-			outputModel.SetPolyDataConnection(reverse.GetOutputPort())
+		outputModel.SetAndObservePolyData(surface)
+
+		if request != None:
+			self.__subdividedModels[outputModel.GetID()] = request['subdivide'] or not request['useDelaunay']
+			self.__concaveModels[outputModel.GetID()] = request['concave']
+			self.__modelHullVersions[outputModel.GetID()] = request['hullVersion']
 
 		# Create default model display node if does not exist yet
 		if not outputModel.GetDisplayNode():
@@ -172,9 +1099,137 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
 			outputModel.SetAndObserveDisplayNodeID(modelDisplayNode.GetID())
 	
 		outputModel.GetDisplayNode().SliceIntersectionVisibilityOn()
-			
+
 		outputModel.Modified()
 
+	def getConcaveSurface(self, coordinates, subdivide=True):
+		"""
+		Return the alpha shape of the points: the surface of the Delaunay tetrahedra whose circumsphere
+		radius is below alpha, which follows concavities that the convex hull fills in. Alpha is scaled
+		from the largest nearest-neighbour distance, found with a k-d tree, so that no point is left out
+		where markups are sparse. With subdivide on, the surface is smoothed. Returns None if no
+		tetrahedron is small enough, e.g. when all points are in one plane.
+		"""
+
+		points = vtk.vtkPoints()
+		for coordinate in coordinates:
+			points.InsertNextPoint(coordinate)
+		pointPolyData = vtk.vtkPolyData()
+		pointPolyData.SetPoints(points)
+
+		locator = vtk.vtkKdTreePointLocator()
+		locator.SetDataSet(pointPolyData)
+		locator.BuildLocator()
+
+		# The closest point to each markup is the markup itself, so look for two.
+		neighbours = vtk.vtkIdList()
+		spacing = 0.0
+		for coordinate in coordinates:
+			locator.FindClosestNPoints(2, coordinate, neighbours)
+			nearest = coordinates[neighbours.GetId(1)]
+			spacing = max(spacing, math.sqrt(sum([(coordinate[axis] - nearest[axis])**2 for axis in range(3)])))
+
+		if spacing == 0:
+			return None
+
+		delaunay = vtk.vtkDelaunay3D()
+		delaunay.SetInputData(pointPolyData)
+		delaunay.SetAlpha(self.concaveAlphaScale * spacing)
+		delaunay.AlphaTetsOn()
+		delaunay.AlphaTrisOff()
+		delaunay.AlphaLinesOff()
+		delaunay.AlphaVertsOff()
+
+		surfaceFilter = vtk.vtkDataSetSurfaceFilter()
+		surfaceFilter.SetInputConnection(delaunay.GetOutputPort())
+		surfaceFilter.Update()
+
+		if surfaceFilter.GetOutput().GetNumberOfCells() == 0:
+			return None
+
+		if not subdivide:
+			surface = vtk.vtkPolyData()
+			surface.ShallowCopy(surfaceFilter.GetOutput())
+			return surface
+
+		# Alpha shapes can be non-manifold where tetrahedra meet at an edge, which the
+		# subdivision filters used for convex models do not accept.
+		smoother = vtk.vtkWindowedSincPolyDataFilter()
+		smoother.SetInputConnection(surfaceFilter.GetOutputPort())
+		smoother.SetNumberOfIterations(20)
+		smoother.SetPassBand(0.1)
+		smoother.NonManifoldSmoothingOn()
+		smoother.NormalizeCoordinatesOn()
+		smoother.BoundarySmoothingOff()
+
+		normals = vtk.vtkPolyDataNormals()
+		normals.SetInputConnection(smoother.GetOutputPort())
+		normals.SplittingOff()
+		normals.Update()
+
+		surface = vtk.vtkPolyData()
+		surface.ShallowCopy(normals.GetOutput())
+		return surface
+
+	def getHalfTorusCoordinates(self, numberOfPoints, random):
+		"""
+		Random points filling half a torus, a concave shape, drawn from the numpy RandomState random.
+		"""
+
+		angle = random.uniform(0, math.pi, numberOfPoints)
+		radius = 10 * numpy.sqrt(random.uniform(0, 1, numberOfPoints))
+		tubeAngle = random.uniform(0, 2 * math.pi, numberOfPoints)
+		return numpy.array([(30 + radius * numpy.cos(tubeAngle)) * numpy.cos(angle),
+							(30 + radius * numpy.cos(tubeAngle)) * numpy.sin(angle),
+							radius * numpy.sin(tubeAngle)]).T.tolist()
+
+	def benchmarkConcaveSurface(self, pointCounts=[10, 100, 500], repeats=3):
+		"""
+		Time building a concave surface against the convex Delaunay surface used otherwise, for random
+		points in a half torus. Returns one dict per point count with the best time of each method over
+		repeats: the smoothed and raw concave surface, and the subdivided Delaunay surface.
+		"""
+
+		random = numpy.random.RandomState(0)
+		results = []
+
+		for numberOfPoints in pointCounts:
+			coordinates = self.getHalfTorusCoordinates(numberOfPoints, random)
+
+			points = vtk.vtkPoints()
+			for coordinate in coordinates:
+				points.InsertNextPoint(coordinate)
+			pointPolyData = vtk.vtkPolyData()
+			pointPolyData.SetPoints(points)
+
+			delaunayTimes = []
+			concaveTimes = []
+			rawConcaveTimes = []
+			for repeat in range(repeats):
+				startTime = time.time()
+				delaunay = vtk.vtkDelaunay3D()
+				delaunay.SetInputData(pointPolyData)
+				surfaceFilter = vtk.vtkDataSetSurfaceFilter()
+				surfaceFilter.SetInputConnection(delaunay.GetOutputPort())
+				smoother = vtk.vtkButterflySubdivisionFilter()
+				smoother.SetInputConnection(surfaceFilter.GetOutputPort())
+				smoother.SetNumberOfSubdivisions(3)
+				smoother.Update()
+				delaunayTimes.append(time.time() - startTime)
+
+				startTime = time.time()
+				self.getConcaveSurface(coordinates)
+				concaveTimes.append(time.time() - startTime)
+
+				startTime = time.time()
+				self.getConcaveSurface(coordinates, subdivide=False)
+				rawConcaveTimes.append(time.time() - startTime)
+
+			results.append({'points': numberOfPoints, 'delaunaySeconds': min(delaunayTimes),
+							'concaveSeconds': min(concaveTimes), 'rawConcaveSeconds': min(rawConcaveTimes)})
+
+		return results
+
 	def showInSliceViewers(self, volumeNode, sliceWidgetNames):
 		# Displays volumeNode in the selected slice viewers as background volume
 		# Existing background volume is pushed to foreground, existing foreground volume will not be shown anymore
@@ -193,4 +1248,185 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
 				# there is a background volume, push it to the foreground because we will replace the background volume
 				sliceLogic.GetSliceCompositeNode().SetForegroundVolumeID(backgroundVolumeNodeID)
 			# show the new volume as background
-			sliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(newVolumeNodeID)
\ No newline at end of file
+			sliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(newVolumeNodeID)
+class IncrementalConvexHull(object):
+	"""
+	Convex hull of a point set, kept as outward-facing triangles with unit plane normals. Adding a point
+	only replaces the faces it can see, and moving a point that is not a hull vertex is handled the same
+	way. Moving a hull vertex, which can make neighbouring faces concave, rebuilds the hull from the points;
+	this is still far cheaper than a Delaunay tetrahedralization.
+	"""
+
+	def __init__(self):
+		self.__points = numpy.zeros((0,3))
+		self.__faces = numpy.zeros((0,3), dtype=numpy.int64)
+		self.__normals = numpy.zeros((0,3))
+		self.__offsets = numpy.zeros(0)
+		self.__interior = None
+		self.__tolerance = 0
+
+		# Counts the changes to the points, so that each user of the hull can tell
+		# whether it changed since it last looked, whoever updated it in between.
+		self.__version = 0
+
+	def points(self):
+		return self.__points
+
+	def version(self):
+		return self.__version
+
+	def faces(self):
+		return self.__faces
+
+	def planes(self):
+		"""
+		Return [normals, offsets]; a point x is inside the hull when dot(normals, x) <= offsets for all faces.
+		"""
+		return [self.__normals, self.__offsets]
+
+	def isValid(self):
+		return len(self.__faces) > 0
+
+	def update(self, points):
+		"""
+		Bring the hull up to date with points, working out whether one point was added or moved.
+		Returns False if the points did not change at all.
+		"""
+
+		points = numpy.array(points, dtype=numpy.float64).reshape(-1,3)
+		oldPoints = self.__points
+
+		if points.shape == oldPoints.shape:
+			moved = numpy.flatnonzero((points != oldPoints).any(axis=1))
+			if moved.size == 0:
+				return False
+			if moved.size == 1:
+				self.movePoint(moved[0], points[moved[0]])
+				return True
+		elif len(points) == len(oldPoints) + 1 and (points[:-1] == oldPoints).all():
+			self.addPoint(points[-1])
+			return True
+
+		self.setPoints(points)
+		return True
+
+	def setPoints(self, points):
+		"""
+		Build the hull from scratch, starting from a tetrahedron and inserting the other points.
+		"""
+
+		self.__version += 1
+		self.__points = numpy.array(points, dtype=numpy.float64).reshape(-1,3)
+		self.__faces = numpy.zeros((0,3), dtype=numpy.int64)
+		self.__normals = numpy.zeros((0,3))
+		self.__offsets = numpy.zeros(0)
+
+		simplex = self.__findSimplex()
+		if simplex == None:
+			return
+
+		self.__interior = self.__points[simplex].mean(axis=0)
+		a, b, c, d = simplex
+		self.__setFaces(numpy.array([[a,b,c], [a,b,d], [a,c,d], [b,c,d]]))
+
+		for index in range(len(self.__points)):
+			if index not in simplex:
+				self.__insert(index)
+
+	def addPoint(self, point):
+		self.__version += 1
+		self.__points = numpy.vstack([self.__points, point])
+		if self.isValid():
+			self.__insert(len(self.__points) - 1)
+		else:
+			self.setPoints(self.__points)
+
+	def movePoint(self, index, point):
+		isVertex = (self.__faces == index).any()
+		self.__version += 1
+		self.__points[index] = point
+		if self.isValid() and not isVertex:
+			self.__insert(index)
+		else:
+			self.setPoints(self.__points)
+
+	def polyData(self):
+		"""
+		Return the hull as a triangle vtkPolyData containing only the hull vertices.
+		"""
+
+		vertices = numpy.unique(self.__faces)
+		renumber = numpy.zeros(len(self.__points), dtype=numpy.int64)
+		renumber[vertices] = numpy.arange(len(vertices))
+
+		points = vtk.vtkPoints()
+		points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(self.__points[vertices]), deep=1))
+
+		triangles = vtk.vtkCellArray()
+		for face in renumber[self.__faces]:
+			triangles.InsertNextCell(3)
+			for vertex in face:
+				triangles.InsertCellPoint(int(vertex))
+
+		polyData = vtk.vtkPolyData()
+		polyData.SetPoints(points)
+		polyData.SetPolys(triangles)
+		return polyData
+
+	def __findSimplex(self):
+
+		# Four points spanning a non-degenerate tetrahedron, or None if all points are coplanar.
+		points = self.__points
+		if len(points) < 4:
+			return None
+
+		scale = numpy.ptp(points, axis=0).max()
+		if scale == 0:
+			return None
+		self.__tolerance = 1e-9 * scale
+
+		a = 0
+		b = int(numpy.argmax(numpy.linalg.norm(points - points[a], axis=1)))
+		c = int(numpy.argmax(numpy.linalg.norm(numpy.cross(points - points[a], points[b] - points[a]), axis=1)))
+
+		normal = numpy.cross(points[b] - points[a], points[c] - points[a])
+		if numpy.linalg.norm(normal) <= self.__tolerance * scale:
+			return None
+		normal = normal / numpy.linalg.norm(normal)
+
+		heights = numpy.dot(points - points[a], normal)
+		d = int(numpy.argmax(numpy.abs(heights)))
+		if abs(heights[d]) <= self.__tolerance:
+			return None
+
+		return [a, b, c, d]
+
+	def __insert(self, index):
+
+		point = self.__points[index]
+		visible = numpy.dot(self.__normals, point) - self.__offsets > self.__tolerance
+		if not visible.any():
+			return
+
+		# The horizon is made of the edges of visible faces whose neighbouring face is hidden.
+		edges = set()
+		for a, b, c in self.__faces[visible]:
+			edges.update([(a,b), (b,c), (c,a)])
+		horizon = [[a, b, index] for a, b in edges if (b, a) not in edges]
+
+		self.__setFaces(numpy.vstack([self.__faces[~visible], numpy.array(horizon, dtype=numpy.int64)]))
+
+	def __setFaces(self, faces):
+
+		# Orient every face so that its normal points away from the interior point.
+		points = self.__points
+		normals = numpy.cross(points[faces[:,1]] - points[faces[:,0]], points[faces[:,2]] - points[faces[:,0]])
+		inward = numpy.einsum('ij,ij->i', normals, self.__interior - points[faces[:,0]]) > 0
+		faces[inward] = faces[inward][:,[0,2,1]]
+		normals[inward] = -normals[inward]
+
+		lengths = numpy.linalg.norm(normals, axis=1)
+		lengths[lengths == 0] = 1
+		self.__faces = faces
+		self.__normals = normals / lengths[:,None]
+		self.__offsets = numpy.einsum('ij,ij->i', self.__normals, points[faces[:,0]])
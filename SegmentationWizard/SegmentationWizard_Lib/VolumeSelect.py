@@ -171,6 +171,12 @@ class VolumeSelectStep(SegmentationWizardStep) :
 		pNode.SetParameter('originalFollowupVolumeID', '')
 
 		pNode.SetParameter('registrationVolumeID', '')
+		pNode.SetParameter('registrationMaskID', '')
+		pNode.SetParameter('registrationMovingMaskID', '')
+		pNode.SetParameter('registrationROINodeID', '')
+		pNode.SetParameter('registrationNCC', '')
+		pNode.SetParameter('registrationMI', '')
+		pNode.SetParameter('registrationMAD', '')
 		pNode.SetParameter('baselineNormalizeVolumeID', '')
 		pNode.SetParameter('followupNormalizeVolumeID', '')
 		pNode.SetParameter('subtractVolumeID', '')
@@ -182,7 +188,10 @@ class VolumeSelectStep(SegmentationWizardStep) :
 
 		pNode.SetParameter('thresholdedLabelID', '')
 		pNode.SetParameter('croppedVolumeID', '')
+		pNode.SetParameter('croppedVolumeList', '')
+		pNode.SetParameter('clipFillValue', '')
 		pNode.SetParameter('nonThresholdedLabelID', '')
+		pNode.SetParameter('roiComponentsLabelID', '')
 
 		pNode.SetParameter('roiNodeID', '')
 		pNode.SetParameter('roiTransformID', '')
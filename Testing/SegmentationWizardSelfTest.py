@@ -1,7 +1,9 @@
 
 import os
 import unittest
+import numpy
 from __main__ import vtk, qt, ctk, slicer
+from vtk.util import numpy_support
 
 class SegmentationWizardSelfTest:
   def __init__(self, parent):
@@ -176,8 +178,27 @@ class SegmentationWizardSelfTestTest(unittest.TestCase):
         self.delayDisplay('Go Forward')
         modelsegmentation_module.workflow.goForward()
 
+        self.delayDisplay('Register Images within an ROI')
+        registrationStep = modelsegmentation_module.Step2
+        bounds = [0] * 6
+        baselineNode.GetRASBounds(bounds)
+        registrationROI = slicer.vtkMRMLAnnotationROINode()
+        registrationROI.SetXYZ([(bounds[2*axis] + bounds[2*axis+1]) / 2.0 for axis in range(3)])
+        registrationROI.SetRadiusXYZ(30, 30, 30)
+        slicer.mrmlScene.AddNode(registrationROI)
+        registrationStep._RegistrationStep__ROICheckBox.setChecked(True)
+        registrationStep._RegistrationStep__ROISelector.setCurrentNode(registrationROI)
+        registrationStep.onRegistrationRequest(wait_for_completion=True)
+        self.assertEqual(registrationStep._RegistrationStep__status, 'Completed')
+        registrationStep._RegistrationStep__ROICheckBox.setChecked(False)
+
         self.delayDisplay('Register Images')
         modelsegmentation_module.Step2.onRegistrationRequest(wait_for_completion=True)
+        pNode = modelsegmentation_module.Step2.parameterNode()
+        for metric in ['NCC', 'MI', 'MAD']:
+            self.assertNotEqual(pNode.GetParameter('registration' + metric), '')
+            float(pNode.GetParameter('registration' + metric))
+        self.assertTrue(-1 <= float(pNode.GetParameter('registrationNCC')) <= 1)
 
         self.delayDisplay('Go Forward')
         modelsegmentation_module.workflow.goForward()
@@ -209,6 +230,39 @@ class SegmentationWizardSelfTestTest(unittest.TestCase):
         inputMarkup.AddFiducial(-5,5,60)
         inputMarkup.AddFiducial(-5,-35,-30)
 
+        self.delayDisplay('Benchmark hull clipping against stencil clipping')
+        roiStep = modelsegmentation_module.Step4
+        benchmark = roiStep._ROIStep__logic.benchmarkHullClip(roiStep._ROIStep__visualizedVolume, inputMarkup, roiStep._ROIStep__clippingModelNode)
+        self.assertGreater(benchmark['dice'], 0.99)
+        self.assertLessEqual(abs(benchmark['halfSpaceVoxels'] - benchmark['stencilVoxels']), 0.02 * benchmark['stencilVoxels'])
+
+        self.delayDisplay('Voxelize empty and degenerate ROIs')
+        roiLogic = roiStep._ROIStep__logic
+        self.assertEqual(roiLogic.getROIMask(roiStep._ROIStep__visualizedVolume, [], [], True, 5), [None, None])
+        flatMarkup = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(flatMarkup)
+        flatMarkup.AddFiducial(0, 0, 0)
+        flatMarkup.AddFiducial(10, 0, 0)
+        emptyModel = slicer.vtkMRMLModelNode()
+        slicer.mrmlScene.AddNode(emptyModel)
+        self.assertEqual(roiLogic.getROIMask(roiStep._ROIStep__visualizedVolume, [flatMarkup], [emptyModel], True, 5), [None, None])
+        self.assertEqual(roiLogic.getROIComponentMasks(roiStep._ROIStep__visualizedVolume, [flatMarkup], [emptyModel], True, 5), [])
+        slicer.mrmlScene.RemoveNode(flatMarkup)
+        slicer.mrmlScene.RemoveNode(emptyModel)
+
+        self.delayDisplay('Build a concave surface')
+        surface = roiLogic.getConcaveSurface(roiLogic.getHalfTorusCoordinates(50, numpy.random.RandomState(0)))
+        self.assertIsNotNone(surface)
+        self.assertGreater(surface.GetNumberOfCells(), 0)
+        boundaryEdges = vtk.vtkFeatureEdges()
+        boundaryEdges.SetInputData(surface)
+        boundaryEdges.BoundaryEdgesOn()
+        boundaryEdges.FeatureEdgesOff()
+        boundaryEdges.NonManifoldEdgesOff()
+        boundaryEdges.ManifoldEdgesOff()
+        boundaryEdges.Update()
+        self.assertEqual(boundaryEdges.GetOutput().GetNumberOfCells(), 0)
+
         self.delayDisplay('Go Forward')
         modelsegmentation_module.workflow.goForward()
 
@@ -216,6 +270,11 @@ class SegmentationWizardSelfTestTest(unittest.TestCase):
         modelsegmentation_module.Step5._ThresholdStep__threshRange.minimumValue = 50
         modelsegmentation_module.Step5._ThresholdStep__threshRange.maximumValue = 150
 
+        self.delayDisplay('Check incremental thresholding against vtkImageThreshold')
+        # The second range moves both ends, so only the voxels in between are relabelled.
+        for lower, upper in [[50, 150], [70, 120]]:
+            self.checkThresholdLabel(modelsegmentation_module.Step5, lower, upper)
+
         self.delayDisplay('Go Forward')
         modelsegmentation_module.workflow.goForward()
 
@@ -227,4 +286,42 @@ class SegmentationWizardSelfTestTest(unittest.TestCase):
     except Exception, e:
         import traceback
         traceback.print_exc()
-        self.delayDisplay('Test caused exception!\n' + str(e))
\ No newline at end of file
+        self.delayDisplay('Test caused exception!\n' + str(e))
+        raise
+
+  def checkThresholdLabel(self, thresholdStep, lower, upper):
+    """ Sets the threshold range, waits for the background update, and
+    compares the label with the histogram count and with vtkImageThreshold
+    over the same sub-extent of the ROI volume.
+    """
+    thresholdStep._ThresholdStep__threshRange.minimumValue = lower
+    thresholdStep._ThresholdStep__threshRange.maximumValue = upper
+    thresholdStep.onThresholdChanged()
+    thresholdStep._ThresholdStep__thresholdScheduler.finish()
+
+    engine = thresholdStep._ThresholdStep__thresholdEngine
+    label = thresholdStep._ThresholdStep__thresholdLabel
+    roiVolume = thresholdStep._ThresholdStep__roiVolume
+    labelCount = int(numpy_support.vtk_to_numpy(label.imageData.GetPointData().GetScalars()).sum())
+
+    # Voxels at or below the clip fill value are outside the ROI, and never labelled.
+    fillValue = thresholdStep.parameterNode().GetParameter('clipFillValue')
+    referenceLower = lower
+    if fillValue != '' and lower <= float(fillValue):
+      referenceLower = float(fillValue) + 1e-6
+
+    clip = vtk.vtkImageClip()
+    clip.SetInputData(roiVolume.GetImageData())
+    clip.SetOutputWholeExtent(engine.extent())
+    clip.ClipDataOn()
+    threshold = vtk.vtkImageThreshold()
+    threshold.SetInputConnection(clip.GetOutputPort())
+    threshold.ThresholdBetween(referenceLower, upper)
+    threshold.SetInValue(1)
+    threshold.SetOutValue(0)
+    threshold.SetOutputScalarTypeToShort()
+    threshold.Update()
+    referenceCount = int(numpy_support.vtk_to_numpy(threshold.GetOutput().GetPointData().GetScalars()).sum())
+
+    self.assertEqual(labelCount, thresholdStep._ThresholdStep__roiHistogram.count(lower, upper))
+    self.assertEqual(labelCount, referenceCount)